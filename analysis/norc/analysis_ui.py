@@ -6,22 +6,44 @@
 # See the LICENSE file in the base directory for details.
 
 import sys
+import argparse
 from PySide6.QtWidgets import QApplication
 from PySide6.QtUiTools import QUiLoader
 from PySide6.QtGui import QColor
 from norc.classes.application_state import ApplicationState
+from norc.helpers.util import parse_size, default_measurement_cache_size
 from norc.ui.mainwindow import main_window
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(prog="norc_gui")
+    parser.add_argument("experiment_root", nargs="?")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        action="store",
+        default=1,
+        help="Number of worker threads calculating plots and scores.",
+    )
+    parser.add_argument(
+        "--memory",
+        type=parse_size,
+        action="store",
+        default=default_measurement_cache_size,
+        help="Memory for keeping measurements and data derived from them loaded between calculations, e.g. 4G.",
+    )
+    # Remaining arguments are left to Qt.
+    args, qt_args = parser.parse_known_args()
+
     loader = QUiLoader()
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qt_args)
     # app.setStyle("Windows")
     app.setPalette(QColor(255, 255, 255, 255))
-    appstate = ApplicationState(loader)
+    appstate = ApplicationState(loader, args.jobs, args.memory)
 
-    if len(sys.argv) > 1:
-        appstate.plt_mgr.open_experiment(sys.argv[1])
+    if args.experiment_root is not None:
+        appstate.plt_mgr.open_experiment(args.experiment_root)
 
     mw = main_window(appstate)
 
@@ -30,4 +52,3 @@ def main() -> None:
 
 if __name__ == "__main__":
     main()
-
@@ -7,16 +7,17 @@
 
 import os
 from norc.core.plotmanager import PlotManager
+from norc.helpers.util import default_measurement_cache_size
 
 
 class ApplicationState:
-    def __init__(self, loader):
+    def __init__(self, loader, n_workers=1, memory_limit=default_measurement_cache_size):
         script_location = os.path.dirname(os.path.abspath(__file__))
         self.ui_dir = os.path.join(script_location, "..", "ui")
         self.ui_dir = os.path.abspath(self.ui_dir)
 
         self.loader = loader
-        self.plt_mgr = PlotManager()
+        self.plt_mgr = PlotManager(n_workers, memory_limit)
 
     def load_ui(self, fname):
         """Load a .ui file from the UI directory."""
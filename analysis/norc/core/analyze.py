@@ -6,154 +6,542 @@
 # See the LICENSE file in the base directory for details.
 
 import os
-import sys
+import json
+import pickle
 import shutil
+import argparse
 import numpy as np
 from copy import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from pycubexr import CubexParser
 from tqdm import tqdm
-from norc.helpers.util import dir_info, warn, iterate_measurements, callpath_data, write_measurement
+from norc.helpers.util import (
+    dir_info,
+    warn,
+    iterate_measurements,
+    measurement_data,
+    counted_set,
+    open_deviations,
+    write_measurement,
+    segment_ranges,
+    summary_builder,
+    summary_bytes_per_deviation,
+    experiment_catalog,
+    measurement_size,
+    parse_size,
+)
+from norc.helpers.cubex import cubex_profile
 
 flt_isdir = lambda f: f.is_dir() and not f.name.startswith(".")
 
 
-def analyze(output_dir, info: dir_info):
-    counter_data = {}
-    callpath_names = {}
-    callpath_id_mapping = {}
-
-    selected_metrics = info.counters.strip(",").split(",") + ["time", "visits"]
-
-    for metric_name in selected_metrics:
-        counter_data[metric_name] = {}
-
-    # Total number of threads across all nodes and processes
-    n_threads = info.n_nodes * info.n_processes * info.n_threads
-
-    experiment_dirs = []
+# Returns the paths of all profiles that belong to a measurement.
+def profile_paths(info: dir_info):
+    paths = []
     for d in info.dirs:
-        experiment_dirs += filter(flt_isdir, os.scandir(d))
-
-    for exdir in experiment_dirs:
-        if not os.path.exists(os.path.join(exdir, "profile.cubex")):
-            continue
-
-        try:
-            with CubexParser(os.path.join(exdir, "profile.cubex")) as experiment:
-                for metric_name in selected_metrics:
-                    metric_values = experiment.get_metric_values(experiment.get_metric_by_name(metric_name))
-
-                    total_callpaths = 0
-                    skipped_name = 0
-                    skipped_threadcount = 0
-
-                    def iterate_cnodes(cnode, path):
-                        nonlocal total_callpaths
-                        nonlocal skipped_name
-                        nonlocal skipped_threadcount
-
-                        for child in cnode.get_children():
-                            iterate_cnodes(child, path + [child.region.name])
-
-                        if cnode.id not in metric_values.cnode_indices:
-                            return
-
-                        region = cnode.region
-                        vals = np.abs(metric_values.cnode_values(cnode))
-                        total_callpaths += 1
-
-                        # Skip callpaths with missing threads
-                        if len(vals) != n_threads:
-                            skipped_threadcount += 1
-                            return
-
-                        cnode_idx = cnode.id
-                        # Store a human-readable-ish region name for each callpath.
-                        if cnode_idx not in callpath_names:
-                            callpath_names[cnode_idx] = region.name
-                            callpath_id_mapping[tuple(path)] = cnode_idx
-                        elif callpath_names[cnode_idx] != region.name:
-                            path_tpl = tuple(path)
-                            if path_tpl in callpath_id_mapping:
-                                cnode_idx = callpath_id_mapping[path_tpl]
-                            else:
-                                skipped_name += 1
-                                return
-
-                        if cnode_idx not in counter_data[metric_name]:
-                            counter_data[metric_name][cnode_idx] = []
-                        counter_data[metric_name][cnode_idx].append(vals)
-
-                    for cnode_ in experiment.get_root_cnodes():
-                        iterate_cnodes(cnode_, [cnode_.region.name])
-
-                    description = f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric_name}"
-                    if skipped_name > 0:
-                        warn(f"{skipped_name}/{total_callpaths} callpaths skipped due to name mismatch ({description})")
-                    if skipped_threadcount > 0:
-                        warn(
-                            f"{skipped_threadcount}/{total_callpaths} callpaths skipped due to thread count mismatch ({description})"
-                        )
-
-        except KeyboardInterrupt:
-            print("Exiting on keyboard interrupt")
-            exit(0)
-        except:
-            warn(f"Skipping {exdir}")
-            continue
-
-    for metric, callpaths in counter_data.items():
-        # Visits are stored in each file but no calculations on them are necessary.
-        if metric == "visits":
-            continue
-
-        callpath_datas = []
-        # Since each thread should have the same number of repetitions per call path, the mean can act as a surrogate sum for contribution calculation.
-        total_mean = 0
-        for cnode_idx, values in callpaths.items():
-
-            cpd = callpath_data(callpath_names[cnode_idx])
-            mean = np.mean(values, axis=0)  # mean for each thread across runs
+        for exdir in filter(flt_isdir, os.scandir(d)):
+            path = os.path.join(exdir, "profile.cubex")
+            if os.path.exists(path):
+                paths.append(path)
+    return paths
+
+
+# Returns the names of all metrics that are read from a measurement's profiles.
+def selected_metrics(info: dir_info):
+    return info.counters.strip(",").split(",") + ["time", "visits"]
+
+
+# Returns the file name under which a metric's result is stored.
+def result_name(info: dir_info, metric):
+    return f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric}.dev"
+
+
+class profile_data:
+    """Values of the selected metrics of a single profile, indexed by its flattened call tree."""
+
+    def __init__(self, profile: cubex_profile):
+        # The call tree is flattened once in post-order (children before their parent).
+        # Each cnode is identified by the region names along its path. Cnodes sharing a path are told apart by
+        # their occurrence in this order, so that the same callpath has the same key in every profile.
+        self.cnode_ids = []
+        self.names = []
+        self.callpaths = []
+        occurrences = {}
+        stack = [(cnode, (cnode.region.name,), False) for cnode in reversed(profile.root_cnodes())]
+        while stack:
+            cnode, path, visited = stack.pop()
+            if visited:
+                self.cnode_ids.append(cnode.id)
+                self.names.append(cnode.region.name)
+                occurrence = occurrences.get(path, 0)
+                occurrences[path] = occurrence + 1
+                self.callpaths.append((path, occurrence))
+                continue
+            stack.append((cnode, path, True))
+            for child in reversed(cnode.get_children()):
+                stack.append((child, path + (child.region.name,), False))
+
+        self.n_locations = profile.n_locations
+
+        # For each metric, a mask of the cnodes it has values for and the absolute values of those cnodes
+        # as a (cnodes x locations) float64 array. The arrays are collected as they are and never modified.
+        self.present = {}
+        self.values = {}
+        cnode_ids = np.asarray(self.cnode_ids, dtype=np.int64)
+        for metric_name, metric_cnodes in profile.cnode_ids.items():
+            # Lookup table from cnode id to the row of the metric's values
+            lut = np.full(max(cnode_ids.max(initial=-1), metric_cnodes.max(initial=-1)) + 1, -1, dtype=np.int64)
+            lut[metric_cnodes] = np.arange(len(metric_cnodes))
+            rows = lut[cnode_ids]
+            present = rows >= 0
+            self.present[metric_name] = present
+            self.values[metric_name] = np.abs(profile.values[metric_name][rows[present]], dtype=np.float64)
+
+
+class measurement_collector:
+    """Gathers the values of all profiles belonging to one measurement and derives its deviations."""
+
+    def __init__(self, info: dir_info, state_dir, memory_budget=0, excluded=frozenset()):
+        self.info = info
+        # Values of each metric as a list of (callpaths x threads) arrays, one per profile, alongside the callpath ids of their rows.
+        self.counter_data = {}
+        self.counter_callpaths = {}
+        self.callpath_names = {}
+        self.callpath_id_mapping = {}
+
+        # Collected values are stored in the state directory with one file per metric, so that a later analysis can
+        # resume from them. With a memory budget, values are moved there as soon as they exceed the budget.
+        # The callpath ids of all rows are kept in memory since they are small in comparison.
+        self.memory_budget = memory_budget
+        self.state_dir = state_dir
+        self.pending_bytes_ = 0
+        self.spilled_rows_ = {}
+
+        # Results that are excluded because another measurement writes them are not collected at all.
+        # Visits are always needed for the remaining results.
+        self.selected_metrics = [
+            m for m in selected_metrics(info) if m == "visits" or result_name(info, m) not in excluded
+        ]
+
+        for metric_name in self.selected_metrics:
+            self.counter_data[metric_name] = []
+            self.counter_callpaths[metric_name] = []
+            self.spilled_rows_[metric_name] = 0
+
+        # Total number of threads across all nodes and processes
+        self.n_threads = info.n_nodes * info.n_processes * info.n_threads
+
+        if os.path.exists(self.state_file_("callpaths", "pickle")):
+            self.load_()
+
+    # Maps each cnode of a profile to the id of the callpath it belongs to within this measurement.
+    # Callpaths are identified by their keys rather than by cnode ids, which differ between call trees.
+    def resolve_callpaths_(self, profile: profile_data):
+        callpath_names = self.callpath_names
+        callpath_id_mapping = self.callpath_id_mapping
+
+        any_present = np.logical_or.reduce(list(profile.present.values()))
+        callpath_ids = np.full(len(profile.cnode_ids), -1, dtype=np.int64)
+        for i in np.flatnonzero(any_present):
+            key = profile.callpaths[i]
+            cnode_idx = callpath_id_mapping.get(key)
+            if cnode_idx is None:
+                cnode_idx = len(callpath_id_mapping)
+                callpath_id_mapping[key] = cnode_idx
+                # Store a human-readable-ish region name for each callpath.
+                callpath_names[cnode_idx] = profile.names[i]
+            callpath_ids[i] = cnode_idx
+        return callpath_ids
+
+    def add_profile(self, profile: profile_data):
+        info = self.info
+
+        # Skip callpaths with missing threads
+        threads_match = profile.n_locations == self.n_threads
+        if threads_match:
+            callpath_ids = self.resolve_callpaths_(profile)
+            # Pending values are spilled before the values of this profile would exceed the budget.
+            incoming = sum(profile.values[metric_name].nbytes for metric_name in self.selected_metrics)
+            if self.memory_budget > 0 and self.pending_bytes_ + incoming > self.memory_budget:
+                self.spill_()
+
+        for metric_name in self.selected_metrics:
+            present = profile.present[metric_name]
+            if threads_match:
+                values = profile.values[metric_name]
+                self.counter_callpaths[metric_name].append(callpath_ids[present])
+                self.counter_data[metric_name].append(values)
+                self.pending_bytes_ += values.nbytes
+                continue
+
+            skipped_threadcount = np.count_nonzero(present)
+            if skipped_threadcount > 0:
+                description = (
+                    f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric_name}"
+                )
+                warn(
+                    f"{skipped_threadcount}/{len(present)} callpaths skipped due to thread count mismatch ({description})"
+                )
+
+    def state_file_(self, name, extension):
+        return os.path.join(self.state_dir, f"{name}.{extension}")
+
+    # Moves all values that are still held in memory to the state files.
+    def spill_(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        for metric_name, blocks in self.counter_data.items():
+            if not blocks:
+                continue
+            # The pending blocks belong to the most recent callpath ids.
+            ids = self.counter_callpaths[metric_name][-len(blocks) :]
+            with open(self.state_file_(metric_name, "bin"), "ab") as values:
+                with open(self.state_file_(metric_name, "ids"), "ab") as callpaths:
+                    for block, block_ids in zip(blocks, ids):
+                        block.tofile(values)
+                        block_ids.tofile(callpaths)
+                        self.spilled_rows_[metric_name] += len(block)
+            blocks.clear()
+        self.pending_bytes_ = 0
+
+    # Stores everything collected so far in the state directory.
+    def save(self):
+        self.spill_()
+        with open(self.state_file_("callpaths", "pickle"), "wb") as f:
+            pickle.dump((self.callpath_names, self.callpath_id_mapping), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Continues from the values stored by a previous analysis.
+    def load_(self):
+        with open(self.state_file_("callpaths", "pickle"), "rb") as f:
+            self.callpath_names, self.callpath_id_mapping = pickle.load(f)
+
+        for metric_name in self.selected_metrics:
+            path = self.state_file_(metric_name, "ids")
+            if not os.path.exists(path):
+                continue
+            ids = np.fromfile(path, dtype=np.int64)
+            self.counter_callpaths[metric_name].append(ids)
+            self.spilled_rows_[metric_name] = len(ids)
+
+    # Returns all values of a metric as a single (rows x threads) array.
+    # Spilled values are memory-mapped from their state file instead of being loaded.
+    def values_(self, metric_name):
+        if self.spilled_rows_[metric_name] == 0:
+            return np.concatenate(self.counter_data[metric_name])
+
+        self.spill_()
+        return np.memmap(
+            self.state_file_(metric_name, "bin"),
+            dtype=np.float64,
+            mode="r",
+            shape=(self.spilled_rows_[metric_name], self.n_threads),
+        )
+
+    # Splits the callpaths into consecutive ranges whose values fit into the memory budget.
+    # Every range contains at least one callpath.
+    def callpath_ranges_(self, runs):
+        row_size = self.n_threads * np.dtype(np.float64).itemsize
+        return segment_ranges(runs * row_size, self.memory_budget)
+
+    # Returns the rank of each callpath id when the callpaths are sorted by their keys.
+    def callpath_ranks_(self):
+        ranks = np.empty(len(self.callpath_id_mapping), dtype=np.int64)
+        for rank, key in enumerate(sorted(self.callpath_id_mapping)):
+            ranks[self.callpath_id_mapping[key]] = rank
+        return ranks
+
+    # Returns the callpaths of a metric sorted by their keys, their number of runs
+    # and their values as (runs x threads) matrices.
+    # Each matrix is loaded on demand for a range of callpaths and is contiguous within the returned array.
+    def run_matrices_(self, metric_name):
+        if not self.counter_callpaths[metric_name]:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), []
+
+        ids = np.concatenate(self.counter_callpaths[metric_name])
+        values = self.values_(metric_name)
+
+        # Callpaths are sorted by their keys, which keeps the results independent of the order of the profiles.
+        ranks = self.callpath_ranks_()
+        callpath_ranks, row_rank = np.unique(ranks[ids], return_inverse=True)
+        callpaths = np.argsort(ranks)[callpath_ranks]
+
+        # A stable sort keeps the runs of each callpath in the order of their profiles.
+        rows = np.argsort(row_rank, kind="stable")
+        runs = np.bincount(row_rank)
+        starts = np.cumsum(runs) - runs
+
+        ranges = self.callpath_ranges_(runs)
+        loaded = {}
+
+        def matrices(begin, end):
+            # Without a memory budget all matrices are loaded at once and can be reused between passes.
+            if (begin, end) in loaded:
+                return loaded[begin, end]
+            mats = values[rows[starts[begin] : starts[end - 1] + runs[end - 1]]]
+            if len(ranges) == 1:
+                loaded[begin, end] = mats
+            return mats
+
+        return callpaths, runs, [(begin, end, matrices) for begin, end in ranges]
+
+    def write(self, output_dir):
+        info = self.info
+        callpath_names = self.callpath_names
+
+        # Visits are stored in each file but no calculations on them are necessary apart from their total.
+        visits = {}
+        visit_callpaths, visit_runs, ranges = self.run_matrices_("visits")
+        for begin, end, matrices in ranges:
+            starts = np.cumsum(visit_runs[begin:end]) - visit_runs[begin:end]
+            totals = np.add.reduceat(np.sum(matrices(begin, end), axis=1), starts)
+            visits.update(zip(visit_callpaths[begin:end], totals))
+
+        for metric in self.selected_metrics:
+            if metric == "visits":
+                continue
+
+            callpaths, runs, ranges = self.run_matrices_(metric)
+
+            # The first pass calculates the mean for each thread across runs.
+            means = np.zeros((len(callpaths), self.n_threads))
+            for begin, end, matrices in ranges:
+                starts = np.cumsum(runs[begin:end]) - runs[begin:end]
+                means[begin:end] = np.add.reduceat(matrices(begin, end), starts, axis=0) / runs[begin:end, np.newaxis]
+
+            # Since each thread should have the same number of repetitions per call path, the mean can act as a surrogate sum for contribution calculation.
+            callpath_means = np.sum(means, axis=1)
+            total_mean = np.sum(callpath_means)
 
             # It is not possible to calculate a meaningful deviation coefficient for zero-mean measurements.
             # For that reason and because these measurements will typically be all zeros anyway, blowing the zero-bin
             # out of proportion, these measurements are omitted.
-            non_zero_mask = mean != 0
-
-            # Record visits alongside deviation for filtering
-            cpd.visits = np.sum(counter_data["visits"][cnode_idx])
-
-            # This is used to calculate the callpath's contribution later.
-            total_mean += np.sum(mean)
-
-            # Calculate the relative deviation from mean
-            for thread_mean, thread_vals in zip(mean[non_zero_mask], np.transpose(values)[non_zero_mask]):
-                cpd.deviations += list(100 * abs(thread_vals - thread_mean) / thread_mean)
-
-            # Callpaths are stored alongside their total mean from which the contribution can be calculated later
-            callpath_datas.append((np.sum(mean), cpd))
-
-        # Calculate each call path's contribution once the total is known
-        callpaths_only = []
-        for mean, cpd in callpath_datas:
-            if not cpd.deviations:
-                continue  # Skip empty callpaths
-            # Record contribution alongside deviation for filtering
-            cpd.contribution = 100 * mean / total_mean
-            callpaths_only.append(cpd)
-
-        pickle_name = (
-            f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric}.pickle"
+            non_zero_mask = means != 0
+
+            # Callpaths without any non-zero-mean thread are skipped. The deviations of the others are stored thread by
+            # thread, each holding the deviations of all runs, so their number is known before they are calculated.
+            valid_threads = np.count_nonzero(non_zero_mask, axis=1)
+            kept = valid_threads > 0
+            lengths = runs * valid_threads
+            offsets = np.concatenate([[0], np.cumsum(lengths[kept], dtype=np.int64)])
+
+            names = counted_set()
+            name_ids = []
+            for i in np.flatnonzero(kept):
+                name = callpath_names[callpaths[i]]
+                names.insert(name)
+                name_ids.append(names.counts[name])
+
+            # The second pass calculates the relative deviation from mean for the runs of one callpath at a time and
+            # writes them straight into the stored deviations, which are memory-mapped. The summaries of a range of
+            # callpaths are calculated once its matrices are released, in chunks that fit into the memory budget.
+            destination = os.path.join(output_dir, result_name(info, metric))
+            deviations = open_deviations(destination, offsets[-1])
+            summaries = summary_builder()
+            position = 0
+            for begin, end, matrices in ranges:
+                mats = matrices(begin, end)
+                range_position = position
+                start = 0
+                for i in range(begin, end):
+                    if kept[i]:
+                        mask = non_zero_mask[i]
+                        devs = mats[start : start + runs[i], mask] - means[i, mask]
+                        np.abs(devs, out=devs)
+                        np.multiply(devs, 100, out=devs)
+                        np.divide(devs, means[i, mask], out=devs)
+                        deviations[position : position + lengths[i]].reshape(valid_threads[i], runs[i])[...] = devs.T
+                        position += lengths[i]
+                    start += runs[i]
+                del mats
+
+                counts = lengths[begin:end][kept[begin:end]]
+                chunk_offsets = range_position + np.concatenate([[0], np.cumsum(counts)])
+                for b, e in segment_ranges(counts, self.memory_budget // summary_bytes_per_deviation):
+                    summaries.add(deviations[chunk_offsets[b] : chunk_offsets[e]], counts[b:e])
+
+            # Record visits and contribution alongside deviation for filtering
+            data = measurement_data(
+                np.array(names.ordered_elements(), dtype=str),
+                np.array(name_ids, dtype=np.int32),
+                np.array([visits[c] for c in callpaths[kept]], dtype=np.float64),
+                100 * callpath_means[kept] / total_mean,
+                offsets,
+                deviations,
+            )
+            summaries.apply(data)
+            deviations.flush()
+            write_measurement(destination, data, staged=True)
+
+
+# Returns the size and modification time of a profile, which identify the version that was analyzed.
+def profile_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Version of the collected state. States of other versions are discarded and their tasks analyzed again.
+state_version = 2
+
+
+def manifest_file(state_dir):
+    return os.path.join(state_dir, "manifest.json")
+
+
+# Returns the manifest of the profiles a task's state was collected from, or None if there is no usable state.
+def read_manifest(state_dir):
+    try:
+        with open(manifest_file(state_dir), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class analysis_task:
+    """A group of measurements that is analyzed together and the profiles of it that still need to be read.
+
+    Measurements may share an umbrella measurement which receives the values of all their profiles.
+    The values collected for each measurement are kept in the task's state directory alongside a manifest of all
+    profiles they came from. Unless a profile listed there has changed or disappeared, the task resumes from this
+    state and only reads profiles that were added since.
+    """
+
+    def __init__(self, name, infos, umbrella: dir_info = None, excluded=frozenset()):
+        self.name = name
+        self.infos = infos
+        self.umbrella = umbrella
+        # Results listed in excluded are neither calculated nor written.
+        self.excluded = excluded
+        self.result_dir = ""
+        self.state_dir = ""
+        self.resume = False
+        # Relative path and stamp of each profile per noise pattern, and the profiles that still have to be read
+        self.profiles = {}
+        self.pending = {}
+
+    # Returns the measurement and metric of each result written by the task.
+    def result_metrics(self):
+        for info in self.infos + [self.umbrella]:
+            if not info:
+                continue
+            for m in selected_metrics(info):
+                if m != "visits" and result_name(info, m) not in self.excluded:
+                    yield info, m
+
+    def results(self):
+        return {result_name(info, m) for info, m in self.result_metrics()}
+
+    def write_manifest(self):
+        manifest = {
+            "version": state_version,
+            "excluded": sorted(self.excluded),
+            "profiles": self.profiles,
+            "results": sorted(self.results()),
+        }
+        with open(manifest_file(self.state_dir), "w") as f:
+            json.dump(manifest, f)
+
+    # Determines which profiles need to be read. Returns the results of a previous analysis that are now outdated.
+    def plan(self, result_dir, output_dir, state_root):
+        self.result_dir = result_dir
+        self.state_dir = os.path.join(state_root, self.name)
+        self.profiles = {
+            info.noise_pattern: {os.path.relpath(p, result_dir): profile_stamp(p) for p in profile_paths(info)}
+            for info in self.infos
+        }
+
+        manifest = read_manifest(self.state_dir)
+        self.resume = (
+            manifest is not None
+            and manifest.get("version") == state_version
+            and manifest["excluded"] == sorted(self.excluded)
+            and all(
+                self.profiles.get(noise, {}).get(path) == stamp
+                for noise, recorded in manifest["profiles"].items()
+                for path, stamp in recorded.items()
+            )
+            and all(os.path.exists(os.path.join(output_dir, name)) for name in self.results())
         )
-        write_measurement(os.path.join(output_dir, pickle_name), callpaths_only)
 
+        recorded = manifest["profiles"] if self.resume else {}
+        self.pending = {
+            noise: [os.path.join(result_dir, p) for p in profiles if p not in recorded.get(noise, {})]
+            for noise, profiles in self.profiles.items()
+        }
+        return set(manifest["results"]) if manifest and not self.resume else set()
+
+    def n_pending(self):
+        return sum(len(p) for p in self.pending.values())
+
+
+# Analyzes the pending profiles of a task and stores its results.
+# Each profile is only loaded once, no matter how many measurements it contributes to.
+# With a memory budget, collected values exceeding it are moved to the state directory early.
+# The budget is shared between the measurement that is currently analyzed and the umbrella.
+def analyze(output_dir, task: analysis_task, memory_budget=0):
+    if not task.resume:
+        shutil.rmtree(task.state_dir, ignore_errors=True)
+    os.makedirs(task.state_dir, exist_ok=True)
+    # Without a manifest, an interrupted analysis starts over the next time instead of resuming from partial state.
+    if os.path.exists(manifest_file(task.state_dir)):
+        os.remove(manifest_file(task.state_dir))
+
+    if task.umbrella:
+        memory_budget //= 2
+
+    state_dir = lambda info: os.path.join(task.state_dir, info.noise_pattern)
+    umbrella_collector = None
+    if task.umbrella:
+        umbrella_collector = measurement_collector(
+            task.umbrella, state_dir(task.umbrella), memory_budget, task.excluded
+        )
 
-def analyze_experiment(experiment_root):
+    n_profiles = 0
+    for info in task.infos:
+        profiles = task.pending[info.noise_pattern]
+        if task.resume and not profiles:
+            continue  # The results of this measurement are up to date
+
+        collector = measurement_collector(info, state_dir(info), memory_budget, task.excluded)
+        metrics = collector.selected_metrics
+        if umbrella_collector:
+            metrics = list(dict.fromkeys(metrics + umbrella_collector.selected_metrics))
+
+        for profile in profiles:
+            try:
+                data = profile_data(cubex_profile(profile, metrics))
+                collector.add_profile(data)
+                if umbrella_collector:
+                    umbrella_collector.add_profile(data)
+
+            except KeyboardInterrupt:
+                print("Exiting on keyboard interrupt")
+                exit(0)
+            except:
+                warn(f"Skipping {os.path.dirname(profile)}")
+                # Profiles that couldn't be read aren't recorded, so that they are read again next time.
+                del task.profiles[info.noise_pattern][os.path.relpath(profile, task.result_dir)]
+                continue
+
+        # Individual results are written as soon as possible to free their memory.
+        collector.write(output_dir)
+        collector.save()
+        n_profiles += len(profiles)
+
+    if umbrella_collector and (n_profiles > 0 or not task.resume):
+        umbrella_collector.write(output_dir)
+        umbrella_collector.save()
+
+    task.write_manifest()
+    return n_profiles
+
+
+def analyze_experiment(experiment_root, jobs=1, memory_budget=0, rebuild=False):
     result_dir = os.path.join(experiment_root, "result")
     output_dir = os.path.join(result_dir, ".deviations")
-    shutil.rmtree(output_dir, ignore_errors=True)
-    os.makedirs(output_dir)
+    state_root = os.path.join(output_dir, ".state")
+    # Results without any state stem from an older version and can't be updated.
+    if rebuild or not os.path.isdir(state_root):
+        shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(state_root, exist_ok=True)
 
     # First, collect all the files belonging to measurements with identical parameters.
     # These are then analyzed together.
@@ -165,28 +553,120 @@ def analyze_experiment(experiment_root):
         else:
             measurements[key].dirs += meas.dirs
 
-        # Noisy measurements are also added to an umbrella noise pattern that combines all noisy measurements.
-        # NOTE: Doing it like this is not the most efficent approach since it requires each file to be loaded and processed twice.
+    # Noisy measurements are also added to an umbrella noise pattern that combines all noisy measurements.
+    # All measurements of the same umbrella are analyzed together so that the umbrella result can be gathered
+    # while the individual noise patterns are processed.
+    tasks = {}
+    for meas in measurements.values():
+        umbrella = None
         if meas.noise_pattern != "NO_NOISE":
-            meas_allnoise = copy(meas)
-            meas_allnoise.noise_pattern = "ALL_NOISE"
-            key = meas_allnoise.tuple()
-            if key not in measurements:
-                measurements[key] = meas_allnoise
-            else:
-                measurements[key].dirs += meas_allnoise.dirs
-
-    # Analyse and store each measurement
-    # NOTE: Parallelizing this doesn't seem to help since most time is spent doing file IO.
-    for meas in tqdm(measurements.values()):
-        analyze(output_dir, meas)
+            umbrella = copy(meas)
+            umbrella.noise_pattern = "ALL_NOISE"
+            umbrella.dirs = []
+
+        key = meas.tuple() if umbrella is None else umbrella.tuple()
+        if key not in tasks:
+            tasks[key] = analysis_task(".".join(map(str, key)), [], umbrella)
+        tasks[key].infos.append(meas)
+
+    # Measurements with different counter sets all record time, which is therefore stored under the same name.
+    # Only the last measurement in analysis order writes such a result, just like it would overwrite all others
+    # if the measurements were analyzed one after another. This keeps parallel results deterministic.
+    written_later = set()
+    for task in reversed(tasks.values()):
+        names = task.results()
+        task.excluded = frozenset(names & written_later)
+        written_later |= names
+
+    # Only profiles that were added since the previous analysis are read. Results that are no longer written by
+    # any measurement are removed, including those of measurements that disappeared entirely.
+    outdated = set()
+    for task in tasks.values():
+        outdated |= task.plan(result_dir, output_dir, state_root)
+    names = {task.name for task in tasks.values()}
+    for stale in filter(lambda f: f.is_dir() and f.name not in names, os.scandir(state_root)):
+        outdated |= set((read_manifest(stale.path) or {}).get("results", []))
+        shutil.rmtree(stale.path)
+    for name in outdated - written_later:
+        shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+
+    pending = [task for task in tasks.values() if not task.resume or task.n_pending() > 0]
+
+    # Analyse and store each measurement.
+    # Progress is counted in profiles rather than measurements so that the throughput is shown in files/s.
+    with tqdm(total=sum(task.n_pending() for task in pending), unit="files") as progress:
+        if jobs <= 1:
+            for task in pending:
+                progress.update(analyze(output_dir, task, memory_budget))
+        else:
+            # Each worker analyzes whole tasks and writes their results itself.
+            # Results are identical to the serial path since every task is still processed by a single analyze() call.
+            with ProcessPoolExecutor(jobs) as exec:
+                futures = [exec.submit(analyze, output_dir, task, memory_budget) for task in pending]
+                for f in as_completed(futures):
+                    progress.update(f.result())
+
+    update_catalog(output_dir, tasks.values(), pending)
+
+
+# Lists all results in the experiment's catalog. Entries of results that weren't written again are kept.
+def update_catalog(output_dir, tasks, updated):
+    previous = {e["file"]: e for e in experiment_catalog(output_dir).entries}
+    updated = {name for task in updated for name in task.results()}
+
+    entries = []
+    for task in tasks:
+        for info, metric in task.result_metrics():
+            name = result_name(info, metric)
+            path = os.path.join(output_dir, name)
+            if name in previous and name not in updated:
+                entries.append(previous[name])
+            elif os.path.exists(path):
+                entries.append(
+                    experiment_catalog.entry(
+                        name,
+                        info.benchmark,
+                        info.params,
+                        info.noise_pattern,
+                        info.system,
+                        info.res_cfg,
+                        metric,
+                        *measurement_size(path),
+                    )
+                )
+    experiment_catalog(output_dir, entries).write()
 
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: nohc_analyze  <experiment_root>")
-    else:
-        analyze_experiment(sys.argv[1])
+    parser = argparse.ArgumentParser(prog="norc_analyze")
+
+    parser.add_argument("experiment_root")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of measurements analyzed in parallel worker processes",
+    )
+    parser.add_argument(
+        "-M",
+        "--memory-budget",
+        action="store",
+        type=parse_size,
+        default=0,
+        help="Memory available to each worker for collected values and deviations, e.g. 512M or 4G. "
+        "Values exceeding it are spilled to disk.",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Discard all previous results and analyze every profile again instead of only new ones",
+    )
+
+    args = parser.parse_args()
+
+    analyze_experiment(args.experiment_root, args.jobs, args.memory_budget, args.rebuild)
 
 
 if __name__ == "__main__":
@@ -8,14 +8,19 @@
 import sys
 import os
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import shlex
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory, resource_tracker
 from copy import copy
 
 import norc.helpers.util as util
 import norc.core.score as scr
+from norc.helpers.cache import result_cache, default_cache_size
 
 from matplotlib import pyplot as plt
 from matplotlib import ticker
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import to_rgba
 import numpy as np
 import numpy.ma as ma
 from tqdm import tqdm
@@ -33,6 +38,7 @@ class plot_settings:
         self.deviation_cutoff = -1
         self.sorted = False
         self.split_after = 0
+        self.file_format = "svg"
 
         self.selection = util.data_selection()
 
@@ -51,9 +57,10 @@ class cached_plot:
     ):
         self.info = info
         self.xs = xs
+        # One smoothed histogram per row for each contribution band that contains callpaths
         self.ys = ys
         self.contributions = contributions  # These contributions represent the reduced contribution bins for plotting
-        self.max_contribution = np.max(contributions)
+        self.max_contribution = np.max(contributions, initial=0)
         self.max_y = max_y
         self.max_deviation = max_deviation
         self.color = color
@@ -110,16 +117,55 @@ def is_noiseless(noise_pattern: str):
     return noise_pattern == "NO_NOISE"
 
 
+class plot_source:
+    """Summaries and stored histograms of all callpaths of a measurement for one bin spread.
+
+    Plots for any plot mode, band count, thresholds and deviation cutoff are prepared from these without reading
+    the measurement again.
+    """
+
+    def __init__(self, p: util.measurement_info, bin_spread, load=util.load_measurement):
+        data = scr.get_filtered_data(p, None, load)
+        self.bin_spread = bin_spread
+        self.visits = data.visits
+        self.contributions = data.contributions
+        self.counts = data.counts
+        self.sums = data.sums
+        self.maxima = data.maxima
+        self.entries = data.histogram_entries(bin_spread)
+
+    # Returns the contributions of the callpaths that pass the thresholds, their histogram entries and the largest
+    # deviation among them. With a positive cutoff, only bins that lie entirely below it are kept, so the cutoff
+    # is applied at the resolution of the bins. The largest deviation is then bounded by the kept bins.
+    def select(self, selection: util.data_selection, cutoff=-1):
+        selected = (self.visits >= selection.visit_threshold) & (self.contributions >= selection.contrib_threshold)
+        callpaths, bin_ids, counts = self.entries
+        kept = selected[callpaths]
+        maxima = self.maxima[selected]
+        max_deviation = np.max(maxima, initial=0)
+
+        if cutoff > 0:
+            bins = util.deviation_bins(self.bin_spread)
+            kept &= bins[bin_ids + 1] <= cutoff
+            max_deviation = np.max(np.minimum(bins[bin_ids[kept] + 1], self.maxima[callpaths[kept]]), initial=0)
+
+        # Callpaths are renumbered to their position among the selected ones.
+        renumbered = np.cumsum(selected) - 1
+        entries = (renumbered[callpaths[kept]], bin_ids[kept], counts[kept])
+        return self.contributions[selected], entries, max_deviation
+
+
 # Calculates all data required or plotting.
 # This makes plotting the same data multiple times more efficient.
-def prepare_plot(settings: plot_settings, p: util.measurement_info):
+# If the histograms of the bin spread are stored, they are taken from the source, which is read if not passed in.
+# Measurements are read with load.
+def prepare_plot(
+    settings: plot_settings, p: util.measurement_info, source: plot_source = None, load=util.load_measurement
+):
     # TODO: Show progress
     if settings.font_size:
         plt.rcParams.update({"font.size": settings.font_size})
-    visits, contributions, deviations = scr.get_filtered_data(p, settings.selection)
-    deviation_score = scr.deviation_score_from_data(visits, contributions, deviations, settings.selection)
 
-    accumulate = get_accumulator(settings.plot_mode)
     # Same colors as in the paper
     colors = ["#1f78b4", "#e47025", "#33a02c"]
     # Noisy measurements point down, clean ones up.
@@ -129,66 +175,128 @@ def prepare_plot(settings: plot_settings, p: util.measurement_info):
         direction = 1
         color = colors[0]
 
-    xs = []
     max_contribution = 100  # np.max(plt_inf.contributions)
-    max_deviation = 0
 
     # The bands are slightly bigger than they have to be so that the maximum contribution doesn't start its own band
     contrib_bin_size = max_contribution / settings.n_bands + 0.0000001
-    band_contributions = [max_contribution]
+    band_contributions = np.array([max_contribution], dtype=np.float64)
     if settings.n_bands > 1:
-        # contributions = np.zeros(color_bands)
         band_contributions = np.linspace(0.0, max_contribution, settings.n_bands)
 
     # Bin widths increase with higher deviations.
-    bins = np.concatenate(
-        [
-            np.arange(0, 100, 0.25),
-            np.arange(101, 300 + settings.bin_spread, 1),
-            np.arange(300 + settings.bin_spread, 1000 + settings.bin_spread, 10),
-        ]
-    )
+    bins = util.deviation_bins(settings.bin_spread)
 
     hist_size = len(bins) - settings.bin_spread
     xs = bins[0:hist_size]
 
-    ys = [np.zeros(0)] * settings.n_bands
+    # The histograms stored during analysis can be used unless the deviations need to be binned differently.
+    if settings.bin_spread in util.histogram_bin_spreads:
+        if source is None:
+            source = plot_source(p, settings.bin_spread, load)
+        deviation_score = scr.deviation_score_from_data(source, settings.selection)
+        contributions, entries, max_deviation = source.select(settings.selection, settings.deviation_cutoff)
+    else:
+        data = scr.get_filtered_data(p, settings.selection, load)
+        deviation_score = scr.deviation_score_from_data(data, settings.selection)
+        contributions = data.contributions
+        entries, max_deviation = data.binned_deviations(bins, settings.deviation_cutoff)
 
-    for vis, contribution, deviation in zip(visits, contributions, deviations):
-        if vis < settings.selection.visit_threshold or contribution < settings.selection.contrib_threshold:
-            continue
+    # Only bands that contain callpaths are kept.
+    bands = (contributions // contrib_bin_size).astype(np.int64)
+    filled_bands, callpath_bands = np.unique(bands, return_inverse=True)
+    ys = band_histograms(entries, contributions, callpath_bands, len(filled_bands), len(bins) - 1, settings)
 
-        if settings.deviation_cutoff > 0:
-            deviation = list(filter(lambda d: d <= settings.deviation_cutoff, deviation))
-        max_deviation = max(max_deviation, np.max(deviation))
+    max_y = np.max(ys, initial=0)
+    ys *= direction
 
-        hst, _ = np.histogram(deviation, bins=bins)
-        hst = np.convolve(
-            hst,
-            np.ones(settings.bin_spread) / settings.bin_spread,
-            "valid",
-        )
+    return cached_plot(p, xs, ys, deviation_score, band_contributions[filled_bands], max_y, max_deviation, color)
 
-        band = int(contribution // contrib_bin_size)
-        # contributions[band] += contribution
-        if len(ys[band]) == 0:
-            ys[band] = hst
-        else:
-            ys[band] = accumulate(ys[band], hst * contribution)
 
-        deviation = []
+# Smooths histograms over bin_spread neighboring bins. Each smoothed bin is the mean of the bin and the bin_spread - 1
+# bins following it, so the result is bin_spread - 1 bins shorter.
+def smooth_histograms(hists, bin_spread):
+    sums = np.zeros((len(hists), hists.shape[1] + 1))
+    np.cumsum(hists, axis=1, out=sums[:, 1:])
+    # Cancellation in the cumulative sums must not produce negative counts.
+    return np.maximum((sums[:, bin_spread:] - sums[:, :-bin_spread]) / bin_spread, 0)
 
-    max_y = 0
-    for i in range(len(ys)):
-        if len(ys[i]) == 0:
-            band_contributions[i] = 0
-            continue
 
-        max_y = max(max_y, np.max(ys[i]))
+# Largest number of histogram bins that are expanded at once when taking the maxima of the callpaths of each band
+max_mode_chunk_bins = 1 << 22
 
-        ys[i] *= direction
 
-    return cached_plot(p, xs, ys, deviation_score, band_contributions, max_y, max_deviation, color)
+# Returns the smoothed histograms of the bands from the histogram entries (callpath, bin, count) of all callpaths.
+# Each callpath's histogram is weighted by its contribution and accumulated into its band according to the plot mode.
+def band_histograms(entries, contributions, callpath_bands, n_bands, n_bins, settings: plot_settings):
+    callpaths, bin_ids, counts = entries
+    weights = counts * contributions[callpaths]
+
+    if settings.plot_mode == "sum":
+        # Smoothing is linear, so the sums of the bands are smoothed instead of every callpath.
+        hists = np.bincount(callpath_bands[callpaths] * n_bins + bin_ids, weights=weights, minlength=n_bands * n_bins)
+        return smooth_histograms(hists.reshape(n_bands, n_bins), settings.bin_spread)
+
+    accumulate = get_accumulator(settings.plot_mode)
+    ys = np.zeros((n_bands, n_bins + 1 - settings.bin_spread))
+    # Maxima have to be taken over the smoothed histograms of the individual callpaths. These are expanded in chunks
+    # of callpaths that are sorted by band, so that the maxima of each band within a chunk are a single reduction.
+    order = np.argsort(callpath_bands, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    entry_ranks = rank[callpaths]
+    entry_order = np.argsort(entry_ranks, kind="stable")
+    entry_ranks = entry_ranks[entry_order]
+    bin_ids = bin_ids[entry_order]
+    weights = weights[entry_order]
+
+    chunk_size = max(1, max_mode_chunk_bins // n_bins)
+    for first in range(0, len(order), chunk_size):
+        last = min(first + chunk_size, len(order))
+        begin, end = np.searchsorted(entry_ranks, [first, last])
+        hists = np.bincount(
+            (entry_ranks[begin:end] - first) * n_bins + bin_ids[begin:end],
+            weights=weights[begin:end],
+            minlength=(last - first) * n_bins,
+        )
+        smoothed = smooth_histograms(hists.reshape(last - first, n_bins), settings.bin_spread)
+
+        chunk_bands = callpath_bands[order[first:last]]
+        run_starts = np.flatnonzero(np.diff(chunk_bands, prepend=-1))
+        run_bands = chunk_bands[run_starts]
+        ys[run_bands] = accumulate(ys[run_bands], accumulate.reduceat(smoothed, run_starts, axis=0))
+    return ys
+
+
+# Bands of a plot are drawn as vector shapes in PDF and SVG output as long as there are at most this many of them.
+# Beyond that, they are rasterized because vector files would grow too large to be rendered in reasonable time.
+max_vector_bands = 100
+
+
+# Returns the bands of a plot as a single collection. Each band is filled between its histogram and the baseline, and its
+# first value is extended over the zero area left of the origin.
+def band_collection(xs, tops, baseline, alphas, color, settings: plot_settings):
+    n_bands, n_xs = tops.shape
+    # Outlines of the histograms from left to right, closed along the baseline
+    outlines = np.empty((n_bands, n_xs + 2, 2))
+    outlines[:, :n_xs, 0] = xs
+    outlines[:, :n_xs, 1] = tops
+    outlines[:, n_xs:, 0] = [xs[-1], xs[0]]
+    outlines[:, n_xs:, 1] = baseline
+    zero_areas = np.empty((n_bands, 4, 2))
+    zero_areas[:, :, 0] = [-settings.extended_zero_area, 0, 0, -settings.extended_zero_area]
+    zero_areas[:, :2, 1] = tops[:, :1]
+    zero_areas[:, 2:, 1] = baseline
+
+    face_colors = np.tile(to_rgba(color), (n_bands, 1))
+    face_colors[:, 3] = alphas
+    collection = PolyCollection(
+        list(outlines) + list(zero_areas),
+        facecolors=np.concatenate([face_colors, face_colors]),
+        edgecolors="none",
+        linewidths=0,
+    )
+    collection.set_rasterized(n_bands > max_vector_bands)
+    return collection
 
 
 def plot(ax: plt.Axes, c1: cached_plot, c2: cached_plot, settings: plot_settings):
@@ -196,188 +304,174 @@ def plot(ax: plt.Axes, c1: cached_plot, c2: cached_plot, settings: plot_settings
         plt.rcParams.update({"font.size": settings.font_size})
     max_y = max(c1.max_y, c2.max_y)
     for cache in [c1, c2]:
-        for contribution, y in zip(cache.contributions, cache.ys):
-            if len(y) == 0:
-                continue
-
-            counter_idx = cache.info.counter_index
-
-            # max_contribution = 100
-            max_contribution = cache.max_contribution
-            alpha = np.interp(contribution, [0, max_contribution], [0.1, 0.8])
-            # Y values are normed to 0.5 so that each graph is exactly 1 high
-            ax.fill_between(
-                cache.xs,
-                counter_idx + y / (2 * max_y),
-                counter_idx,
-                color=cache.color,
-                alpha=alpha,
-                linewidth=0,
-            )
-
-            # Plot the first value again for the extended zero area
-            ax.fill_between(
-                [-settings.extended_zero_area, 0],
-                counter_idx + [y[0], y[0]] / (2 * max_y),
-                counter_idx,
-                color=cache.color,
-                alpha=alpha,
-                linewidth=0,
-            )
-
-            direction = 1 if is_noiseless(cache.info.noise_pattern) else -1
-            ax.vlines(
-                cache.deviation_score,
-                counter_idx,
-                counter_idx + (0.5 * direction),
-                colors="black",
-            )
-
-
-def plot_all(experiment_dir, settings: plot_settings):
-    plt_infs = util.available_measurements(experiment_dir, settings.selection)
-
-    unsorted_benchmarks = set()
-    unsorted_systems = set()
-    unsorted_noise = set()
-    unsorted_counters = set()
-
-    for p in plt_infs.values():
-        unsorted_benchmarks.add(p.benchmark)
-        unsorted_systems.add(p.system)
-        # NO_NOISE does not have a dedicated plot and should therefore not occupy any space.
-        if p.noise_pattern != "NO_NOISE":
-            unsorted_noise.add(p.noise_pattern)
-        unsorted_counters.add(p.counter)
-
-    # These establish global orderings within each figure
-    benchmark_indices = util.sorted_index_map(unsorted_benchmarks)
-    system_indices = util.sorted_index_map(unsorted_systems)
-    noise_indices = util.sorted_index_map(unsorted_noise)
-    counter_indices = {}
-
-    if settings.sorted:
-        sel = copy(settings.selection)
-        sel.lump_noise = True
-        sel.lump_params = True
-        sel.lump_systems = True
-        sel.lump_resources = True
-        sel.lump_benchmarks = True
-
-        lumped_infs = util.available_measurements(experiment_dir, sel)
-        scores = {}
-        for inf in tqdm(lumped_infs.values(), "Scoring"):
-            if inf.noise_pattern == "NO_NOISE":
-                continue
-            key = inf.key()
-            scores[key] = scr.score(inf, lumped_infs[inf.noiseless_key()], sel)
-        sgp = scr.score_group(scores)
-        scores = {c: s for c, s in scores.items() if not np.isinf(s.rel_resilience)}
+        if len(cache.ys) == 0:
+            continue
+        counter_idx = cache.info.counter_index
+
+        # max_contribution = 100
+        max_contribution = cache.max_contribution
+        alphas = np.interp(cache.contributions, [0, max_contribution], [0.1, 0.8])
+        # Y values are normed to 0.5 so that each graph is exactly 1 high
+        tops = counter_idx + cache.ys / (2 * max_y)
+        ax.add_collection(band_collection(cache.xs, tops, counter_idx, alphas, cache.color, settings))
+        ax.autoscale_view()
+
+        direction = 1 if is_noiseless(cache.info.noise_pattern) else -1
+        ax.vlines(
+            cache.deviation_score,
+            counter_idx,
+            counter_idx + (0.5 * direction),
+            colors="black",
+        )
 
-        sort_crit = lambda it: it[1].rel_resilience
-        access = lambda it: lumped_infs[it[0]].counter
-        counter_indices = util.sorted_index_map(scores.items(), key=sort_crit, reverse=False, elem_transform=access)
 
+# Returns a copy of plot settings that doesn't change along with them.
+def copy_settings(settings: plot_settings):
+    settings = copy(settings)
+    settings.selection = copy(settings.selection)
+    return settings
+
+
+# Prepares the plot of a measurement or takes it from the cache if it was prepared with the same settings before.
+# get_source optionally returns the plot_source of the measurement and is only called if the plot isn't cached.
+def prepare_plot_cached(
+    settings: plot_settings, p: util.measurement_info, cache=None, get_source=None, load=util.load_measurement
+):
+    get_source = get_source or (lambda: None)
+    if cache is None:
+        return prepare_plot(settings, p, get_source(), load)
+    # The key and the plot must be calculated from the same settings, even if the passed ones change meanwhile.
+    settings = copy_settings(settings)
+    key = cache.plot_key(settings, p)
+    plt_cache = cache.get(key)
+    if plt_cache is None:
+        plt_cache = prepare_plot(settings, p, get_source(), load)
+        cache.put(key, plt_cache)
     else:
-        counter_indices = util.sorted_index_map(unsorted_counters)
-
-    cached_plots = {}
-
-    # Globally largest deviation. Used for determining x-axis length
-    max_deviation = 0
-
-    def prepare_plot_wrapper(p: util.measurement_info):
-        plt_cache = prepare_plot(settings, p)
-        return (p.system, p.benchmark, p.counter, p.noise_pattern), plt_cache
-
-    # Calculate plots for measurements without noise
-    with ThreadPoolExecutor() as exec:
-        futures = []
-        for p in plt_infs.values():
-            futures.append(exec.submit(prepare_plot_wrapper, p))
-        for f in tqdm(futures, desc="Preparing"):
-            k, v = f.result()
-            max_deviation = max(max_deviation, v.max_deviation)
-            cached_plots[k] = v
+        # Keep the info that is passed in since plotting state like the counter index is stored in it.
+        plt_cache.info = p
+    return plt_cache
+
+
+# Scores and prepares the plots of a single counter for several configurations. Each configuration consists of the plot
+# settings, the measurements of the counter to plot, and the lumped measurements noisy and ref of the counter that are
+# scored with score_selection for sorting, if any. Each measurement is read only once for all of them, and only the
+# measurements of one counter are loaded at a time. Returns the scores and plots of each configuration.
+def prepare_counter(configs, cache=None):
+    load = util.measurement_loader()
+    results = []
+    for settings, plot_infos, noisy, ref, score_selection in configs:
+        scores = {}
+        if noisy:
+            scores = scr.score_measurements(noisy, ref, score_selection, cache=cache, load=load)
+        plots = {plot_key(p): prepare_plot_cached(settings, p, cache, load=load) for p in plot_infos}
+        results.append((scores, plots))
+    return results
+
+
+def plot_key(p: util.measurement_info):
+    return (p.system, p.benchmark, p.counter, p.noise_pattern)
+
+
+# Same as prepare_counter, but in a worker process. The histograms are returned in shared memory blocks instead of
+# being pickled, in their place each plot holds the name of its block along with the shape and type of the histograms.
+def prepare_counter_shared(configs, cache=None):
+    results = prepare_counter(configs, cache)
+    for _, plots in results:
+        for plt_cache in plots.values():
+            ys = plt_cache.ys
+            shm = shared_memory.SharedMemory(create=True, size=max(ys.nbytes, 1))
+            np.ndarray(ys.shape, dtype=ys.dtype, buffer=shm.buf)[...] = ys
+            plt_cache.ys = (shm.name, ys.shape, ys.dtype.str)
+            shm.close()
+    return results
+
+
+# Maps the histograms of a plot prepared by prepare_counter_shared and keeps the shared memory block in blocks.
+def attach_shared_plot(plt_cache: cached_plot, blocks):
+    name, shape, dtype = plt_cache.ys
+    shm = shared_memory.SharedMemory(name=name)
+    plt_cache.ys = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    # The block stays mapped until it is closed, so its name can be released right away.
+    shm.unlink()
+    blocks.append(shm)
+    return plt_cache
+
+
+# Scores and prepares the plots of all counters, one counter per task. Each task holds the same number of configurations
+# as passed to prepare_counter, and the scores and plots of all counters are returned for each configuration.
+# With more than one job, the tasks run in a pool of worker processes and the shared memory blocks that hold the
+# histograms are added to blocks. These must be closed once the plots are no longer used. Otherwise, the tasks run in
+# threads.
+def prepare_counters(tasks, n_configs, cache, jobs, blocks):
+    results = [({}, {}) for _ in range(n_configs)]
+    if jobs <= 1:
+        with ThreadPoolExecutor() as exec:
+            futures = [exec.submit(prepare_counter, task, cache) for task in tasks]
+            for f in tqdm(as_completed(futures), total=len(futures), desc="Preparing"):
+                for (scores, cached_plots), (counter_scores, plots) in zip(results, f.result()):
+                    scores.update(counter_scores)
+                    cached_plots.update(plots)
+        return results
+
+    # Workers have to share the resource tracker of this process. Otherwise, each would start its own and
+    # try to release the blocks it created when it exits, although they were handed over to this process.
+    resource_tracker.ensure_running()
+    with ProcessPoolExecutor(jobs) as exec:
+        futures = {exec.submit(prepare_counter_shared, task, cache): task for task in tasks}
+        for f in tqdm(as_completed(futures), total=len(futures), desc="Preparing"):
+            for (scores, cached_plots), config, (counter_scores, plots) in zip(results, futures[f], f.result()):
+                scores.update(counter_scores)
+                for p in config[1]:
+                    plt_cache = attach_shared_plot(plots[plot_key(p)], blocks)
+                    # The worker prepared the plot for a copy of the info, but the counter index is set on the original.
+                    plt_cache.info = p
+                    cached_plots[plot_key(p)] = plt_cache
+    return results
+
+
+# Plots of a figure of plot_all along with its layout. This is all that is needed to draw the figure, so it can be
+# passed to a worker process.
+class figure_spec:
+    def __init__(self, name, height, plot_rows, plot_cols, counter_names, max_deviation):
+        self.name = name
+        self.height = height
+        self.plot_rows = plot_rows
+        self.plot_cols = plot_cols
+        self.counter_names = counter_names
+        # Globally largest deviation. Used for determining x-axis length
+        self.max_deviation = max_deviation
+        # Pairs of noisy and noiseless plots by the benchmark, row and column of their subplot
+        self.subplots = {}
 
-    splitting_enabled = settings.split_after > 0
-    split_after = settings.split_after if splitting_enabled else 1e9
 
-    for p in plt_infs.values():
-        if p.counter not in counter_indices:
-            continue
-        p.counter_index = counter_indices[p.counter] % split_after
+def draw_figure(settings: plot_settings, spec: figure_spec):
+    if settings.font_size:
+        plt.rcParams.update({"font.size": settings.font_size})
+    fig = plt.figure(spec.name, figsize=(settings.plot_width * spec.plot_cols, spec.height))
 
-    plot_rows = len(noise_indices)
-    plot_cols = len(benchmark_indices)
-    vslack = 0
-    fig_width = settings.plot_width * plot_cols
-    figs = {}
     axes = {}
-    n_parts = int(len(counter_indices) / split_after)
-
-    for p in tqdm(plt_infs.values(), desc="Plotting"):
-        if p.counter not in counter_indices:
-            continue
-        part_idx = int(counter_indices[p.counter] / split_after)
-        counter_rows = split_after if part_idx < n_parts else len(counter_indices) % split_after
-        fig_height = settings.plot_height * (plot_rows * counter_rows) + vslack
-        fig_id = (p.system, part_idx)
-        ax_id = (p.system, p.benchmark, p.noise_pattern, part_idx)
-        # Noiseless plots are drawn each time the corresponding noisy plot is drawn and don't need their own plots.
-        if p.noise_pattern == "NO_NOISE":
-            continue
-        # A figure is created for each new system.
-        if fig_id not in figs:
-            figs[fig_id] = plt.figure(
-                f"{p.system}_{part_idx}",
-                figsize=(
-                    fig_width,
-                    fig_height,
-                ),
-            )
-        fig = figs[fig_id]
-
-        # A subplot is created for each system x benchmark x noise_pattern combination.
-        # All counters for such a combination are placed within the same subplot.
-        if ax_id not in axes:
-            width = plot_cols
-            x = benchmark_indices[p.benchmark]
-            y = noise_indices[p.noise_pattern]
-            ax = fig.add_subplot(
-                plot_rows,
-                plot_cols,
-                y * width + x + 1,
-            )
-
-            counter_names = [name for name, idx in counter_indices.items() if part_idx == int(idx / split_after)]
-            setup_chart(ax, settings, p, p.noise_pattern, counter_names)
-            if max_deviation <= 100:
-                ax.set_xlim(-settings.extended_zero_area, 100)
-            axes[ax_id] = ax
+    for (benchmark, row, col), pairs in spec.subplots.items():
+        ax = fig.add_subplot(spec.plot_rows, spec.plot_cols, row * spec.plot_cols + col + 1)
+        p = pairs[0][0].info
+        setup_chart(ax, settings, p, p.noise_pattern, spec.counter_names)
+        if spec.max_deviation <= 100:
+            ax.set_xlim(-settings.extended_zero_area, 100)
+        axes[(benchmark, row, col)] = ax
 
         # plot both noisy and clean measurements.
-        plot(
-            axes[ax_id],
-            cached_plots[(p.system, p.benchmark, p.counter, p.noise_pattern)],
-            cached_plots[(p.system, p.benchmark, p.counter, "NO_NOISE")],
-            settings,
-        )
+        for noisy, reference in pairs:
+            plot(ax, noisy, reference, settings)
 
     # Add benchmark labels
-    for key, ax in axes.items():
+    for (benchmark, row, _), ax in axes.items():
         # Only add a benchmark label at the very top
-        if noise_indices[key[2]] != 0:
+        if row != 0:
             continue
         bb = ax.bbox.get_points()
-        axx, axy, axw, axh = (
-            bb[0][0],
-            bb[0][1],
-            bb[1][0] - bb[0][0],
-            bb[1][1] - bb[0][1],
-        )
+        axh = bb[1][1] - bb[0][1]
         ax.annotate(
-            key[1],
+            benchmark,
             xy=(0.5, 1.0 + ((settings.font_size * 2) / axh)),
             xycoords="axes fraction",
             horizontalalignment="center",
@@ -385,15 +479,215 @@ def plot_all(experiment_dir, settings: plot_settings):
             fontsize=settings.font_size,
         )
 
-    # Sanitize format and save plots.
+    # Sanitize format.
     # The format probably still turns out weird because there is so much to draw
     # but it should be fine in the exported plots.
-    for fig_id, fig in figs.items():
-        fig.set_figwidth(settings.plot_width * plot_cols)
-        fig.tight_layout()
-        system = fig_id[0]
-        part = fig_id[1]
-        fig.savefig(f"{system}_{part}.svg", bbox_inches="tight")
+    fig.tight_layout()
+    return fig
+
+
+# Draws a figure and saves it to path. The figure is closed afterwards, so exporting doesn't keep all figures in memory.
+def export_figure(settings: plot_settings, spec: figure_spec, path):
+    fig = draw_figure(settings, spec)
+    fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+
+
+# Measurements and orderings of the figures of one configuration of plot_batch.
+class figure_set:
+    def __init__(self, catalog: util.experiment_catalog, settings: plot_settings, export_dir=None):
+        self.settings = settings
+        self.export_dir = export_dir
+        self.plt_infs = catalog.measurements(settings.selection)
+
+        unsorted_benchmarks = set()
+        unsorted_systems = set()
+        unsorted_noise = set()
+        self.counters = set()
+
+        for p in self.plt_infs.values():
+            unsorted_benchmarks.add(p.benchmark)
+            unsorted_systems.add(p.system)
+            # NO_NOISE does not have a dedicated plot and should therefore not occupy any space.
+            if p.noise_pattern != "NO_NOISE":
+                unsorted_noise.add(p.noise_pattern)
+            self.counters.add(p.counter)
+
+        # These establish global orderings within each figure
+        self.benchmark_indices = util.sorted_index_map(unsorted_benchmarks)
+        self.system_indices = util.sorted_index_map(unsorted_systems)
+        self.noise_indices = util.sorted_index_map(unsorted_noise)
+
+        # Lumped measurements of each counter, which are scored to sort the counters
+        self.lumped_infs = {}
+        self.score_selection = copy(settings.selection)
+        if settings.sorted:
+            self.score_selection.lump_noise = True
+            self.score_selection.lump_params = True
+            self.score_selection.lump_systems = True
+            self.score_selection.lump_resources = True
+            self.score_selection.lump_benchmarks = True
+            self.lumped_infs = catalog.measurements(self.score_selection)
+
+    # Returns the configuration of a counter for prepare_counter.
+    def counter_config(self, counter):
+        plot_infos = [p for p in self.plt_infs.values() if p.counter == counter]
+        ref = {k: inf for k, inf in self.lumped_infs.items() if inf.counter == counter}
+        noisy = {k: inf for k, inf in ref.items() if inf.noise_pattern != "NO_NOISE"}
+        return (self.settings, plot_infos, noisy, ref, self.score_selection)
+
+    # Returns the figures by system and part, given the scores and plots prepared for all counters.
+    def figures(self, scores, cached_plots):
+        settings = self.settings
+
+        # Globally largest deviation. Used for determining x-axis length
+        max_deviation = max((v.max_deviation for v in cached_plots.values()), default=0)
+
+        if settings.sorted:
+            sgp = scr.score_group(scores)
+            scores = {c: s for c, s in scores.items() if not np.isinf(s.rel_resilience)}
+
+            sort_crit = lambda it: it[1].rel_resilience
+            access = lambda it: self.lumped_infs[it[0]].counter
+            counter_indices = util.sorted_index_map(scores.items(), key=sort_crit, reverse=False, elem_transform=access)
+
+        else:
+            counter_indices = util.sorted_index_map(self.counters)
+
+        splitting_enabled = settings.split_after > 0
+        split_after = settings.split_after if splitting_enabled else 1e9
+
+        for p in self.plt_infs.values():
+            if p.counter not in counter_indices:
+                continue
+            p.counter_index = counter_indices[p.counter] % split_after
+
+        plot_rows = len(self.noise_indices)
+        plot_cols = len(self.benchmark_indices)
+        vslack = 0
+        n_parts = int(len(counter_indices) / split_after)
+
+        # A figure is created for each system and part. Its subplots are collected first, so that figures can be drawn
+        # independently of each other.
+        figures = {}
+        for p in self.plt_infs.values():
+            if p.counter not in counter_indices:
+                continue
+            # Noiseless plots are drawn each time the corresponding noisy plot is drawn and don't need their own plots.
+            if p.noise_pattern == "NO_NOISE":
+                continue
+            part_idx = int(counter_indices[p.counter] / split_after)
+            fig_id = (p.system, part_idx)
+            if fig_id not in figures:
+                counter_rows = split_after if part_idx < n_parts else len(counter_indices) % split_after
+                counter_names = [name for name, idx in counter_indices.items() if part_idx == int(idx / split_after)]
+                figures[fig_id] = figure_spec(
+                    f"{p.system}_{part_idx}",
+                    settings.plot_height * (plot_rows * counter_rows) + vslack,
+                    plot_rows,
+                    plot_cols,
+                    counter_names,
+                    max_deviation,
+                )
+
+            # A subplot is created for each system x benchmark x noise_pattern combination.
+            # All counters for such a combination are placed within the same subplot.
+            subplot = (p.benchmark, self.noise_indices[p.noise_pattern], self.benchmark_indices[p.benchmark])
+            figures[fig_id].subplots.setdefault(subplot, []).append(
+                (
+                    cached_plots[(p.system, p.benchmark, p.counter, p.noise_pattern)],
+                    cached_plots[(p.system, p.benchmark, p.counter, "NO_NOISE")],
+                )
+            )
+        return figures
+
+
+# Draws and saves figures. Without an export_dir, the figures are saved to the working directory and kept open to be
+# shown. Otherwise, they are saved to export_dir and closed, using jobs worker processes.
+def draw_figures(settings: plot_settings, figures, jobs=1, export_dir=None):
+    if export_dir is None:
+        # The figures stay open so that they can be shown afterwards.
+        for spec in tqdm(figures.values(), desc="Plotting"):
+            draw_figure(settings, spec).savefig(f"{spec.name}.{settings.file_format}", bbox_inches="tight")
+        return
+
+    os.makedirs(export_dir, exist_ok=True)
+    paths = {
+        fig_id: os.path.join(export_dir, f"{spec.name}.{settings.file_format}") for fig_id, spec in figures.items()
+    }
+    if jobs <= 1:
+        for fig_id, spec in tqdm(figures.items(), desc="Plotting"):
+            export_figure(settings, spec, paths[fig_id])
+        return
+
+    # Workers draw without a GUI, whichever backend this process uses.
+    with ProcessPoolExecutor(jobs, initializer=plt.switch_backend, initargs=("Agg",)) as exec:
+        futures = [exec.submit(export_figure, settings, spec, paths[fig_id]) for fig_id, spec in figures.items()]
+        for f in tqdm(as_completed(futures), total=len(futures), desc="Plotting"):
+            f.result()
+
+
+# Draws and saves the figures of several configurations of an experiment, each given as plot settings and the export
+# directory passed to draw_figures. The measurements are loaded once for all configurations, one counter at a time.
+def plot_batch(experiment_dir, configs, cache=None, jobs=1):
+    catalog = util.experiment_catalog(experiment_dir)
+    figure_sets = [figure_set(catalog, settings, export_dir) for settings, export_dir in configs]
+
+    counters = sorted(set().union(*(fs.counters for fs in figure_sets)))
+    tasks = [[fs.counter_config(counter) for fs in figure_sets] for counter in counters]
+
+    # Shared memory holding the histograms prepared by worker processes. It has to stay open while they are plotted.
+    shared_blocks = []
+    results = prepare_counters(tasks, len(figure_sets), cache, jobs, shared_blocks)
+
+    for fs, (scores, cached_plots) in zip(figure_sets, results):
+        draw_figures(fs.settings, fs.figures(scores, cached_plots), jobs, fs.export_dir)
+
+    # The figures hold copies of the histograms, so the shared memory can be released.
+    results.clear()
+    for shm in shared_blocks:
+        shm.close()
+
+
+# Draws and saves all figures of an experiment, see draw_figures.
+def plot_all(experiment_dir, settings: plot_settings, cache=None, jobs=1, export_dir=None):
+    plot_batch(experiment_dir, [(settings, export_dir)], cache, jobs)
+
+
+# Returns the plot settings given by the parsed command line options of norc_plot.
+def settings_from_args(args):
+    settings = plot_settings()
+
+    settings.plot_mode = args.plot_mode
+    settings.selection.contrib_threshold = args.contribution
+    settings.selection.visit_threshold = args.visits
+
+    settings.n_bands = args.n_bands
+    if settings.n_bands <= 0:
+        settings.n_bands = 1 if settings.plot_mode == "sum" else 10000
+
+    settings.selection.filter = util.experiment_filter(
+        args.benchmark, args.system, args.noise, args.counter.replace("PAPI_", "")
+    )
+
+    settings.font_size = args.fontsize
+    settings.plot_width = args.width
+    settings.plot_height = args.height
+    settings.file_format = args.file_format
+
+    for gr in args.groupings.split(","):
+        group_all = gr.startswith("a")
+        settings.selection.lump_benchmarks |= group_all | gr.startswith("b")
+        settings.selection.lump_systems |= group_all | gr.startswith("s")
+        settings.selection.lump_noise |= group_all | gr.startswith("n")
+        settings.selection.lump_params |= group_all | gr.startswith("p")
+        settings.selection.lump_resources |= group_all | gr.startswith("r")
+
+    settings.deviation_cutoff = args.deviation_cutoff
+    settings.sorted = args.sorted
+    settings.split_after = args.split
+
+    return settings
 
 
 def main():
@@ -432,50 +726,85 @@ def main():
     parser.add_argument("--height", type=float, action="store", default=6)
 
     parser.add_argument("--deviation_cutoff", type=int, action="store", default=-1)
+    parser.add_argument("--format", dest="file_format", choices=["png", "pdf", "svg"], default="svg")
+    parser.add_argument(
+        "--export-dir",
+        type=str,
+        action="store",
+        default=None,
+        help="Save the figures to this directory without showing them. Figures are drawn in parallel with --jobs.",
+    )
 
     parser.add_argument(
         "--sorted",
         action="store_true",
     )
+    # Lets a configuration of --batch turn off --sorted given on the command line.
+    parser.add_argument("--no-sorted", dest="sorted", action="store_false")
 
     # More than a million plots are unlikely.
     parser.add_argument("--split", type=int, action="store", default=0)
 
-    args = parser.parse_args()
-
-    settings = plot_settings()
-
-    settings.plot_mode = args.plot_mode
-    settings.selection.contrib_threshold = args.contribution
-    settings.selection.visit_threshold = args.visits
-
-    settings.n_bands = args.n_bands
-    if settings.n_bands <= 0:
-        settings.n_bands = 1 if settings.plot_mode == "sum" else 10000
-
-    settings.selection.filter = util.experiment_filter(
-        args.benchmark, args.system, args.noise, args.counter.replace("PAPI_", "")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        action="store",
+        default=1,
+        help="Number of worker processes for preparing plots. With 1, plots are prepared in threads.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=util.parse_size,
+        action="store",
+        default=default_cache_size,
+        help="Size limit of the plot cache in result/.cache, e.g. 512M. 0 disables the cache.",
     )
 
-    settings.font_size = args.fontsize
-    settings.plot_width = args.width
-    settings.plot_height = args.height
+    parser.add_argument(
+        "--batch",
+        type=str,
+        action="store",
+        default=None,
+        help="File with the options of one configuration per line. All configurations are exported at once. Options of "
+        "a line take precedence over the same options on the command line.",
+    )
 
-    for gr in args.groupings.split(","):
-        group_all = gr.startswith("a")
-        settings.selection.lump_benchmarks |= group_all | gr.startswith("b")
-        settings.selection.lump_systems |= group_all | gr.startswith("s")
-        settings.selection.lump_noise |= group_all | gr.startswith("n")
-        settings.selection.lump_params |= group_all | gr.startswith("p")
-        settings.selection.lump_resources |= group_all | gr.startswith("r")
+    args = parser.parse_args()
 
-    settings.deviation_cutoff = args.deviation_cutoff
-    settings.sorted = args.sorted
-    settings.split_after = args.split
+    cache = result_cache(os.path.join(args.experiment_root, "result", ".cache"), args.cache_size)
+    deviation_dir = os.path.join(args.experiment_root, "result", ".deviations")
+
+    if args.batch is None:
+        if args.export_dir is not None:
+            # Nothing is shown, so no GUI is needed.
+            plt.switch_backend("Agg")
+        plot_all(deviation_dir, settings_from_args(args), cache, args.jobs, args.export_dir)
+        if args.export_dir is None:
+            plt.show()
+        return
+
+    # Options on the command line apply to all configurations unless a configuration sets them itself. Each line is
+    # parsed into a copy of the command line options, where argparse only overwrites the options the line sets.
+    configs = []
+    export_dirs = set()
+    with open(args.batch) as f:
+        for line_no, line in enumerate(f, 1):
+            options = shlex.split(line, comments=True)
+            if not options:
+                continue
+            config_args = parser.parse_args([args.experiment_root] + options, namespace=copy(args))
+            if config_args.export_dir is None or config_args.export_dir in export_dirs:
+                parser.error(f"{args.batch}:{line_no}: Each configuration needs its own --export-dir")
+            export_dirs.add(config_args.export_dir)
+            configs.append((settings_from_args(config_args), config_args.export_dir))
 
-    plot_all(os.path.join(args.experiment_root, "result", ".deviations"), settings)
-    plt.show()
+    plt.switch_backend("Agg")
+    plot_batch(deviation_dir, configs, cache, args.jobs)
 
 
 if __name__ == "__main__":
-    main()
+    # Run main from the imported module, so that cached results are pickled under its name instead of __main__.
+    import norc.core.plot_rel_dev
+
+    norc.core.plot_rel_dev.main()
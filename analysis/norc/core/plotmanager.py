@@ -9,7 +9,6 @@ import cProfile
 import os
 from copy import copy
 from threading import Lock
-import concurrent.futures
 from multiprocessing.pool import ThreadPool
 import numpy as np
 import time
@@ -17,8 +16,24 @@ import time
 from PySide6.QtCore import QObject, Signal
 
 import norc.core.plot_rel_dev as prd
-from norc.core.score import score, score_group
-from norc.helpers.util import measurement_info, available_measurements, experiment_filter, warn
+from norc.core.score import score, score_group, get_threshold_index
+from norc.helpers.util import (
+    measurement_info,
+    experiment_catalog,
+    experiment_filter,
+    histogram_bin_spreads,
+    measurement_cache,
+    default_measurement_cache_size,
+    warn,
+)
+from norc.helpers.cache import result_cache
+from norc.helpers.scheduler import priority_scheduler
+
+# Priorities of calculations. The visible chart comes first, then visible score cells, then results that may be
+# needed soon.
+priority_chart = 0
+priority_table = 1
+priority_prefetch = 2
 
 
 class PlotManager(QObject):
@@ -26,7 +41,7 @@ class PlotManager(QObject):
     score_ready = Signal(measurement_info)
     reconfigured = Signal()
 
-    def __init__(self):
+    def __init__(self, n_workers=1, memory_limit=default_measurement_cache_size):
         super().__init__()
 
         self.experiment_root = ""
@@ -41,6 +56,10 @@ class PlotManager(QObject):
         self.noise_patterns = set()
         self.metrics = set()
 
+        # Index of all measurements of the opened experiment, None if it has not been analyzed
+        self.catalog = None
+        # Scores and plots of previous sessions
+        self.cache = None
         self.infos = {}
         self.cached_plots = {}
         self.scores = score_group()
@@ -48,19 +67,25 @@ class PlotManager(QObject):
         # Internal state for keeping track of calculations
         self.pending_plots_ = {}
         self.pending_scores_ = {}
+        # Loaded measurements shared by all calculations. These are the same whatever the settings and only change
+        # with the experiment. The cache also keeps entries derived from the available measurements within the same
+        # memory limit: threshold indices, from which changed thresholds are rescored without loading any measurement
+        # again, and plot sources, from which plots are prepared for any plot mode, band count and thresholds.
+        self.measurements = measurement_cache(memory_limit)
+        self.infos_version_ = 0
         self.config_version_ = 0
         self.config_mutex_ = Lock()
-        # TODO: This is currently only a single worker because the performance hit
-        # from disk I/O is bigger than the gain from parallel calculations.
-        # This may be solvable but until then one thread keeps the UI responsive-ish
-        # with visible progress in the score table.
-        self.workers_ = concurrent.futures.ThreadPoolExecutor(1)
+        # A single worker is the default because the performance hit from disk I/O is often bigger than the gain
+        # from parallel calculations. Calculations are prioritized, so the visible chart never waits for the whole
+        # score table, and calculations for outdated configurations are cancelled before they start.
+        self.scheduler_ = priority_scheduler(n_workers)
 
     # Internal function that updates the plots available from the current settings.
     # This can change when a file is loaded or parameter treatment changes.
     def update_available_measurements_(self):
         # Remove old parameters
         self.infos.clear()
+        self.discard_measurement_entries_()
 
         self.benchmarks.clear()
         self.systems.clear()
@@ -68,12 +93,11 @@ class PlotManager(QObject):
         self.metrics.clear()
 
         # Check if there is anything to load
-        deviation_dir = os.path.join(self.experiment_root, "result", ".deviations")
-        if not os.path.exists(deviation_dir):
+        if self.catalog is None:
             return
 
         # Get all available plot infos
-        self.infos = available_measurements(deviation_dir, self.plot_settings.selection)
+        self.infos = self.catalog.measurements(self.plot_settings.selection)
 
         # Repopulate parameters
         for inf in self.infos.values():
@@ -92,20 +116,28 @@ class PlotManager(QObject):
                 return
 
             self.config_version_ += 1
+            # Queued calculations of the previous configuration would only be discarded, so they are dropped. Results
+            # that are still valid are requested again.
+            self.scheduler_.cancel_before(self.config_version_)
+            self.pending_plots_.clear()
+            self.pending_scores_.clear()
 
             if clear_plots:
                 self.cached_plots.clear()
-                self.pending_plots_.clear()
 
             if clear_scores:
                 self.scores.clear()
-                self.pending_scores_.clear()
 
         self.reconfigured.emit()
 
     def open_experiment(self, experiment_root):
         def fn():
             self.experiment_root = experiment_root
+            # The catalog is only read once per experiment. Changing the groupings afterwards just queries it.
+            deviation_dir = os.path.join(self.experiment_root, "result", ".deviations")
+            self.catalog = experiment_catalog(deviation_dir) if os.path.exists(deviation_dir) else None
+            self.cache = result_cache(os.path.join(self.experiment_root, "result", ".cache"))
+            self.measurements.clear()
             self.update_available_measurements_()
             return True, True
 
@@ -164,58 +196,134 @@ class PlotManager(QObject):
     def set_filter(self, filter: experiment_filter):
         def fn():
             self.plot_settings.selection.filter = filter
+            self.discard_measurement_entries_()
             return True, True
 
         self.update_config_(fn)
 
+    # Forgets the pending calculation of a result once it has finished, whether it stored a result or not, so that
+    # requesting the result again starts a new calculation if necessary. Pending calculations of older configurations
+    # were already forgotten when the configuration changed.
+    def finish_calculation_(self, pending: dict, key, config_version):
+        with self.config_mutex_:
+            if config_version == self.config_version_:
+                pending.pop(key, None)
+
     def plot_calculation_(self, info: measurement_info, config_version):
-        # Only start a calculation if the results would still be up to date.
+        try:
+            self.calculate_plot_(info, config_version)
+        finally:
+            self.finish_calculation_(self.pending_plots_, info.key(), config_version)
+
+    def score_calculation_(self, info: measurement_info, config_version):
+        try:
+            self.calculate_score_(info, config_version)
+        finally:
+            self.finish_calculation_(self.pending_scores_, info.key(), config_version)
+
+    def calculate_plot_(self, info: measurement_info, config_version):
+        # Only start a calculation if the results would still be up to date. The settings are copied, so that changes
+        # during the calculation can't mix into the result or its cache key.
         with self.config_mutex_:
             if config_version != self.config_version_:
                 return
+            settings = prd.copy_settings(self.plot_settings)
+            cache = self.cache
 
         t_start = time.process_time()
-        # Calculate the plot for the given plot info
-        result = prd.prepare_plot(self.plot_settings, info)
+        # Calculate the plot for the given plot info unless it was cached in a previous session
+        cache_key = cache.plot_key(settings, info) if cache is not None else None
+        result = cache.get(cache_key) if cache is not None else None
+        calculated = result is None
+        if calculated:
+            source = self.plot_source_(info, settings.bin_spread)
+            result = prd.prepare_plot(settings, info, source, self.measurements)
+        else:
+            # Keep the info that is passed in since plotting state like the counter index is stored in it.
+            result.info = info
 
         # Only write the result if it still fits the configuration
         with self.config_mutex_:
             if config_version == self.config_version_:
-                key = info.key()
-                self.cached_plots[key] = result
-                if key in self.pending_plots_:
-                    del self.pending_plots_[key]
+                if calculated and cache is not None:
+                    cache.put(cache_key, result)
+                self.cached_plots[info.key()] = result
 
                 self.result_ready.emit(info)
         t_end = time.process_time()
         # print(f"plot  {info.key()}\t done in {t_end - t_start}s")
 
-    def score_calculation_(self, info: measurement_info, config_version):
-        # Only start a calculation if the results would still be up to date.
+    def calculate_score_(self, info: measurement_info, config_version):
+        if info.noise_pattern == "NO_NOISE":
+            # Score request for NO_NOISE rejected. Scores are always for a noisy/reference pair.
+            return
+
+        # Only start a calculation if the results would still be up to date. The selection is copied, so that changes
+        # during the calculation can't mix into the result or its cache key.
         with self.config_mutex_:
             if config_version != self.config_version_:
                 return
-
-        if info.noise_pattern == "NO_NOISE":
-            # Score request for NO_NOISE rejected. Scores are always for a noisy/reference pair.
+            selection = copy(self.plot_settings.selection)
+            ref_info = self.infos.get(info.noiseless_key())
+            cache = self.cache
+        if ref_info is None:
+            warn(f"Missing reference for {info.key()}")
             return
 
         t_start = time.process_time()
 
-        scr = score(info, self.infos[info.noiseless_key()], self.plot_settings.selection)
+        noisy_index = self.threshold_index_(info)
+        ref_index = self.threshold_index_(ref_info)
+
+        scr = score(info, ref_info, selection, ref_index.totals(selection), noisy_index.totals(selection))
 
         # Only write the result if it still fits the configuration.
         with self.config_mutex_:
             if config_version == self.config_version_:
-                key = info.key()
-                self.scores.put(key, scr)
-                if key in self.pending_scores_:
-                    del self.pending_scores_[key]
+                if cache is not None:
+                    cache.put(cache.score_key(info, ref_info, selection), scr)
+                self.scores.put(info.key(), scr)
                 self.score_ready.emit(info)
 
         t_end = time.process_time()
         # print(f"score {info.key()}\t done in {t_end - t_start}s")
 
+    # Returns the cached score of a noisy measurement, or None if it has to be calculated.
+    def cached_score_(self, info: measurement_info):
+        with self.config_mutex_:
+            cache = self.cache
+            noisy_info = self.infos.get(info.key())
+            ref_info = self.infos.get(info.noiseless_key())
+            selection = copy(self.plot_settings.selection)
+        if cache is None or noisy_info is None or ref_info is None or info.noise_pattern == "NO_NOISE":
+            return None
+        return cache.get(cache.score_key(noisy_info, ref_info, selection))
+
+    # Entries derived from the available measurements are keyed by their version. Entries that are still being built
+    # when the available measurements change are never returned and age out of the cache.
+    def discard_measurement_entries_(self):
+        self.infos_version_ += 1
+        self.measurements.discard(lambda key: isinstance(key, tuple))
+
+    # Returns an entry derived from a measurement, building it if it isn't cached yet.
+    def measurement_entry_(self, kind, key, build):
+        with self.config_mutex_:
+            infos_version = self.infos_version_
+        return self.measurements.entry((kind, infos_version, key), build)
+
+    def threshold_index_(self, info: measurement_info):
+        return self.measurement_entry_(
+            "threshold_index", info.key(), lambda: get_threshold_index(info, self.measurements)
+        )
+
+    # Returns the plot source of a measurement, or None if the histograms of the bin spread aren't stored.
+    def plot_source_(self, info: measurement_info, bin_spread):
+        if bin_spread not in histogram_bin_spreads:
+            return None
+        return self.measurement_entry_(
+            "plot_source", (info.key(), bin_spread), lambda: prd.plot_source(info, bin_spread, self.measurements)
+        )
+
     def request_calculation_(
         self,
         calculation,
@@ -223,6 +331,8 @@ class PlotManager(QObject):
         result_cache: dict,
         pending_in: list,
         pending_out: dict,
+        priority,
+        with_reference=True,
     ):
 
         key = info.key()
@@ -234,11 +344,14 @@ class PlotManager(QObject):
         # Replace partial info with the full one with paths
         info = self.infos[key]
 
+        # Only running calculations are pending. Calculations that are still queued are submitted again, which moves
+        # them up if the priority is higher. Finished and cancelled ones left no result behind, so they start anew.
         def is_pending(key):
-            for p in pending_in:
-                if key in p:
-                    return True
-            return False
+            return any(key in p and p[key].running() for p in pending_in)
+
+        def submit(info):
+            task = (calculation.__name__, info.key())
+            return self.scheduler_.submit(task, priority, self.config_version_, calculation, info, self.config_version_)
 
         noisy = None
         reference = None
@@ -249,7 +362,10 @@ class PlotManager(QObject):
                 noisy = result_cache[key]
             elif not is_pending(key):
                 # If there is no available or pending result, spawn a new calculation for it.
-                pending_out[key] = self.workers_.submit(calculation, info, copy(self.config_version_))
+                pending_out[key] = submit(info)
+
+            if not with_reference:
+                return noisy, None
 
             key_noiseless = info.noiseless_key()
             if key_noiseless in result_cache:
@@ -258,34 +374,55 @@ class PlotManager(QObject):
             elif not is_pending(key_noiseless):
                 # If there is no available or pending result, spawn a new calculation for it.
                 if key_noiseless in self.infos:
-                    pending_out[key_noiseless] = self.workers_.submit(
-                        calculation,
-                        self.infos[key_noiseless],
-                        copy(self.config_version_),
-                    )
+                    pending_out[key_noiseless] = submit(self.infos[key_noiseless])
 
         return noisy, reference
 
-    def request_plot(self, info: measurement_info):
+    def request_plot(self, info: measurement_info, priority=priority_chart):
         return self.request_calculation_(
             self.plot_calculation_,
             info,
             self.cached_plots,
             [self.pending_plots_],
             self.pending_plots_,
+            priority,
         )
 
-    def request_score(self, info: measurement_info):
+    # Prepares the plots of the other noise patterns of a measurement, which are likely to be looked at next.
+    def prefetch_plots(self, info: measurement_info):
+        for noise_pattern in list(self.noise_patterns):
+            if noise_pattern == "NO_NOISE" or noise_pattern == info.noise_pattern:
+                continue
+            neighbor = copy(info)
+            neighbor.noise_pattern = noise_pattern
+            if neighbor.key() in self.infos:
+                self.request_plot(neighbor, priority_prefetch)
+
+    def request_score(self, info: measurement_info, priority=priority_table):
         key = info.key()
         with self.config_mutex_:
             if key in self.scores.scores:
                 return self.scores.scores[key]
+            config_version = self.config_version_
+
+        # Scores calculated in previous sessions are taken from the cache right away.
+        scr = self.cached_score_(info)
+        if scr is not None:
+            with self.config_mutex_:
+                if config_version != self.config_version_:
+                    return None
+                self.scores.put(key, scr)
+            self.score_ready.emit(info)
+            return scr
+
         scr, _ = self.request_calculation_(
             self.score_calculation_,
             info,
             self.scores.scores,
             [self.pending_scores_],
             self.pending_scores_,
+            priority,
+            with_reference=False,
         )
 
         return scr
@@ -9,17 +9,36 @@ import numpy as np
 import sys
 import os
 import argparse
+import csv
+import json
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from tqdm import tqdm
 
-from norc.helpers.util import data_selection, measurement_info, available_measurements, warn, load_measurement
+from norc.helpers.util import (
+    data_selection,
+    measurement_info,
+    available_measurements,
+    warn,
+    load_measurement,
+    parse_size,
+    bin_deviations,
+    segment_positions,
+    histogram_bin_spread,
+)
+from norc.helpers.cache import result_cache, default_cache_size
 
 
 # Summarized deviation and susceptibility scores
 class score:
-    def __init__(self, noisy_info, ref_info, selection):
-        noisy_data = get_filtered_data(noisy_info, selection)
-        ref_data = get_filtered_data(ref_info, selection)
+    # The data of either measurement can be passed in if it is shared between multiple scores. Besides filtered_data,
+    # this may be the totals selected from a threshold_index.
+    def __init__(self, noisy_info, ref_info, selection, ref_data=None, noisy_data=None):
+        if noisy_data is None:
+            noisy_data = get_filtered_data(noisy_info, selection)
+        if ref_data is None:
+            ref_data = get_filtered_data(ref_info, selection)
         # Deviation score for noisy measurement
         self.dev_noisy = deviation_score(noisy_info, selection, noisy_data)
         # Deviation score for reference measurement
@@ -27,63 +46,99 @@ class score:
         # Noise susceptibility score
         self.susceptibility = sensitivity_score(noisy_info, ref_info, selection, noisy_data, ref_data)
 
-        self.rel_resilience = -np.inf
+        # The group this score is ranked in. Its relative resilience depends on all other scores of the group.
+        # Scores that leave a group keep the resilience they last had in it.
+        self.group_ = None
+        self.resilience_ = -np.inf
 
     def deviation(self):
         return max(self.dev_noisy, self.dev_ref)
 
+    # Relative resilience within the score's group. It is calculated when read since it changes with every score
+    # that is added to the group.
+    @property
+    def rel_resilience(self):
+        if self.group_ is None:
+            return self.resilience_
+        return self.group_.resilience(self)
+
+    def leave_group_(self):
+        self.resilience_ = self.rel_resilience
+        self.group_ = None
+
+    # Scores are pickled without their group, whose other scores they don't own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["resilience_"] = self.rel_resilience
+        state["group_"] = None
+        return state
+
 
 class score_group:
     def __init__(self, scores=None):
-        if scores is None:
-            scores = {}
-        self.scores = scores
-        self.update_resilience()
+        self.scores = {}
+        self.reset_extrema_()
+        for key, scr in (scores or {}).items():
+            self.put(key, scr)
+
+    def reset_extrema_(self):
+        self.min_deviation = np.inf
+        self.min_susceptibility = np.inf
+        self.max_deviation = 0
+        self.max_susceptibility = 0
+
+    # The extrema only ever widen when scores are added, so they are updated with each new score.
+    def update_extrema_(self, s):
+        d = s.deviation()
+        if np.isinf(d):
+            return
+        self.min_deviation = min(self.min_deviation, d)
+        self.max_deviation = max(self.max_deviation, d)
+        self.max_susceptibility = max(self.max_susceptibility, s.susceptibility)
+        self.min_susceptibility = min(self.min_susceptibility, s.susceptibility)
 
     def put(self, key, scr):
+        replaced = self.scores.get(key)
+        if replaced is not None:
+            replaced.leave_group_()
         self.scores[key] = scr
-        self.update_resilience()
+        scr.group_ = self
+        if replaced is None:
+            self.update_extrema_(scr)
+            return
 
-    def clear(self):
-        self.scores = {}
+        # The replaced score may have defined an extremum, so they are determined from scratch.
+        self.reset_extrema_()
+        for s in self.scores.values():
+            self.update_extrema_(s)
 
-    def update_resilience(self):
-        if not self.scores:
-            return
-        min_deviation = np.inf
-        min_susceptibility = np.inf
-        max_deviation = 0
-        max_susceptibility = 0
+    def clear(self):
         for s in self.scores.values():
-            d = s.deviation()
-            if np.isinf(s.deviation()):
-                continue
-            min_deviation = min(min_deviation, d)
-            max_deviation = max(max_deviation, d)
-            max_susceptibility = max(max_susceptibility, s.susceptibility)
-            min_susceptibility = min(min_susceptibility, s.susceptibility)
-
-        min_d_normed = min_deviation / max_deviation
-        min_s_normed = min_susceptibility / max_susceptibility
+            s.leave_group_()
+        self.scores = {}
+        self.reset_extrema_()
+
+    def resilience(self, s):
+        if np.isinf(s.deviation()) or np.isinf(s.susceptibility):
+            # Infinity indicates missing data and doesn't need handling.
+            return -np.inf
+        min_d_normed = self.min_deviation / self.max_deviation
+        min_s_normed = self.min_susceptibility / self.max_susceptibility
         susc_weight = min(1.0, min_s_normed / min_d_normed)
-        for k, s in self.scores.items():
-            if np.isinf(s.deviation()) or np.isinf(s.susceptibility):
-                # Infinity indicates missing data and doesn't need handling.
-                continue
-            d_normed = s.deviation() / max_deviation
-            s_normed = s.susceptibility / max_susceptibility
-            self.scores[k].rel_resilience = 1.0 / ((1.0 + d_normed) * (1.0 + s_normed * susc_weight))
+        d_normed = s.deviation() / self.max_deviation
+        s_normed = s.susceptibility / self.max_susceptibility
+        return 1.0 / ((1.0 + d_normed) * (1.0 + s_normed * susc_weight))
 
 
-def deviation_score_from_data(visits, contribution, deviation, selection: data_selection):
-    score = 0.0
+def deviation_score_from_data(data, selection: data_selection):
+    selected = np.ones(len(data.contributions), dtype=bool)
+    if selection:
+        selected = (data.visits >= selection.visit_threshold) & (data.contributions >= selection.contrib_threshold)
+    contributions = data.contributions[selected]
+    score = np.sum(contributions * data.sums[selected] / data.counts[selected])
     # Total contribution of measurements used for the score.
     # Used for scaling to compensate for cutoff loss.
-    total_contribution = 0.0
-    for vis, contrib, devs in zip(visits, contribution, deviation):
-        if vis >= selection.visit_threshold and contrib >= selection.contrib_threshold:
-            score += contrib * np.sum(devs) / len(devs)
-            total_contribution += contrib
+    total_contribution = np.sum(contributions)
 
     if total_contribution == 0:
         assert score == 0.0
@@ -92,67 +147,349 @@ def deviation_score_from_data(visits, contribution, deviation, selection: data_s
     return score / total_contribution
 
 
-def get_filtered_data(info: measurement_info, selection: data_selection):
-    visits = []
-    contributions = []
-    deviations = []
+class filtered_data:
+    """Summaries of the callpaths of a measurement that pass the thresholds of a selection.
+
+    Each summary is a single array across all callpaths, so scores are calculated without iterating over them.
+    The deviations and histograms of the callpaths are read from the stored measurements on request.
+    """
+
+    def __init__(self):
+        # Each measurement along with the indices of its selected callpaths
+        self.parts_ = []
+        self.summaries_ = {}
+        self.moments_ = None
+
+    def __len__(self):
+        return sum(len(indices) for _, indices in self.parts_)
+
+    # Summaries are concatenated on first access.
+    def summary_(self, name):
+        if name not in self.summaries_:
+            self.summaries_[name] = np.concatenate([np.zeros(0)] + [getattr(m, name)[i] for m, i in self.parts_])
+        return self.summaries_[name]
+
+    visits = property(lambda self: self.summary_("visits"))
+    contributions = property(lambda self: self.summary_("contributions"))
+    counts = property(lambda self: self.summary_("counts"))
+    sums = property(lambda self: self.summary_("sums"))
+    sumsqs = property(lambda self: self.summary_("sumsqs"))
+    maxima = property(lambda self: self.summary_("maxima"))
+
+    def add(self, measurement, indices):
+        self.parts_.append((measurement, indices))
+        self.summaries_.clear()
+        self.moments_ = None
+
+    # Returns the mean of the callpaths' mean deviations, weighted by their contribution.
+    def mean(self):
+        return deviation_score_from_data(self, None)
+
+    # Returns the mean and variance of all deviations, with each callpath weighted by its contribution.
+    # The squared deviations from the mean are expanded so that they only depend on the callpath summaries.
+    # The result is kept since references are compared against several noisy measurements.
+    def moments(self):
+        if self.moments_ is None:
+            total_contrib = np.sum(self.contributions)
+            if total_contrib == 0:
+                # Without any contribution, the moments are 0 just like the mean.
+                self.moments_ = (0.0, 0.0)
+                return self.moments_
+            mu = np.sum(self.sums / self.counts * self.contributions) / total_contrib
+
+            variances = (self.sumsqs - 2 * mu * self.sums + self.counts * mu**2) / self.counts
+            # The expansion cancels for constant deviations and may round below 0, which must not reach a square root.
+            sigma_sq = max(np.sum(variances * self.contributions) / total_contrib, 0.0)
+            self.moments_ = (mu, sigma_sq)
+        return self.moments_
+
+    # Returns the entries of the histograms of all callpaths as the callpath, bin and count of each entry.
+    # Callpaths are numbered in the order of the summaries. The histograms stored with the measurements are used.
+    def histogram_entries(self, bin_spread=histogram_bin_spread):
+        entries = []
+        first = 0
+        for m, indices in self.parts_:
+            hist_offsets, hist_bins, hist_counts = m.histograms(bin_spread)
+            positions, lengths = segment_positions(hist_offsets, indices)
+            callpaths = np.repeat(np.arange(first, first + len(indices)), lengths)
+            entries.append((callpaths, hist_bins[positions], hist_counts[positions]))
+            first += len(indices)
+        return self.concatenate_entries_(entries)
+
+    # Same as histogram_entries, but the deviations are binned anew, ignoring those above the cutoff if it is positive.
+    # Also returns the largest deviation that was not ignored.
+    def binned_deviations(self, bins, cutoff=-1):
+        entries = []
+        max_deviation = 0
+        first = 0
+        for m, indices in self.parts_:
+            positions, lengths = segment_positions(m.offsets, indices)
+            deviations = np.asarray(m.deviations[positions], dtype=np.float64)
+            callpaths = np.repeat(np.arange(first, first + len(indices)), lengths)
+            if cutoff > 0:
+                kept = deviations <= cutoff
+                deviations = deviations[kept]
+                callpaths = callpaths[kept]
+            if len(deviations) > 0:
+                max_deviation = max(max_deviation, np.max(deviations))
+
+            valid, bin_ids = bin_deviations(bins, deviations)
+            entries.append((callpaths[valid], bin_ids, np.ones(len(bin_ids))))
+            first += len(indices)
+        return self.concatenate_entries_(entries), max_deviation
+
+    @staticmethod
+    def concatenate_entries_(entries):
+        if len(entries) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return tuple(np.concatenate(column) for column in zip(*entries))
+
+
+# Returns the summaries of all callpaths of a measurement that pass the thresholds.
+# The measurement files are read with load, which may return measurements that were loaded before.
+def get_filtered_data(info: measurement_info, selection: data_selection, load=load_measurement):
+    data = filtered_data()
     for path in info.file_paths:
-        measurement = load_measurement(path)
-        for callpath in measurement:
-            if not selection or (
-                callpath.visits >= selection.visit_threshold and callpath.contribution >= selection.contrib_threshold
-            ):
-                visits.append(callpath.visits)
-                contributions.append(callpath.contribution)
-                deviations.append(callpath.deviations)
+        measurement = load(path)
+        if measurement is None:
+            continue
+        selected = np.ones(len(measurement), dtype=bool)
+        if selection:
+            selected = (measurement.visits >= selection.visit_threshold) & (
+                measurement.contributions >= selection.contrib_threshold
+            )
+        data.add(measurement, np.flatnonzero(selected))
+
+    return data
+
+
+class threshold_totals:
+    """Sums of the score ingredients over the callpaths of a measurement that pass a pair of thresholds."""
+
+    def __init__(self, totals):
+        self.count, self.contribution, self.weighted_mean, self.weighted_sumsq = totals
+
+    def __len__(self):
+        return int(self.count)
+
+    def mean(self):
+        if self.contribution == 0:
+            return 0.0
+        return self.weighted_mean / self.contribution
+
+    # Same as filtered_data.moments, with the squared deviations from the mean expanded into the weighted sums.
+    def moments(self):
+        if self.contribution == 0:
+            return 0.0, 0.0
+        mu = self.weighted_mean / self.contribution
+        sigma_sq = max(self.weighted_sumsq / self.contribution - mu**2, 0.0)
+        return mu, sigma_sq
+
+
+class threshold_index:
+    """Prefix sums of the score ingredients of all callpaths of a measurement, sorted by contribution and by visits.
+
+    The callpaths passing a threshold form a suffix of the respective order, so their totals are found with a binary
+    search. Only if both thresholds exclude callpaths, the shorter of the two suffixes is filtered by the other one.
+    This makes rescoring for new thresholds independent of the stored measurements.
+    """
+
+    def __init__(self, data: filtered_data):
+        contributions = data.contributions
+        # Rows are the callpath count, the contributions and the contribution-weighted means of deviations
+        # and of squared deviations.
+        self.ingredients_ = np.stack(
+            [
+                np.ones(len(contributions)),
+                contributions,
+                contributions * data.sums / data.counts,
+                contributions * data.sumsqs / data.counts,
+            ]
+        )
+        self.visits_ = data.visits
+        self.contributions_ = contributions
+
+        self.visit_order_, self.sorted_visits_, self.visit_suffixes_ = self.sort_(self.visits_)
+        self.contrib_order_, self.sorted_contribs_, self.contrib_suffixes_ = self.sort_(self.contributions_)
+
+    # Returns the order of the callpaths by the given values, the sorted values and the sums of all ingredients
+    # from each position to the end, with a trailing zero for the empty suffix.
+    def sort_(self, values):
+        order = np.argsort(values, kind="stable")
+        suffixes = np.zeros((len(self.ingredients_), len(values) + 1))
+        suffixes[:, :-1] = np.cumsum(self.ingredients_[:, order[::-1]], axis=1)[:, ::-1]
+        return order, values[order], suffixes
+
+    def __len__(self):
+        return len(self.contributions_)
+
+    def totals(self, selection: data_selection):
+        first_visit = np.searchsorted(self.sorted_visits_, selection.visit_threshold, side="left")
+        first_contrib = np.searchsorted(self.sorted_contribs_, selection.contrib_threshold, side="left")
+
+        if first_visit == 0:
+            return threshold_totals(self.contrib_suffixes_[:, first_contrib])
+        if first_contrib == 0:
+            return threshold_totals(self.visit_suffixes_[:, first_visit])
+
+        # Both thresholds exclude callpaths, so the smaller candidate set is checked against the other threshold.
+        if len(self) - first_visit <= len(self) - first_contrib:
+            candidates = self.visit_order_[first_visit:]
+            selected = candidates[self.contributions_[candidates] >= selection.contrib_threshold]
+        else:
+            candidates = self.contrib_order_[first_contrib:]
+            selected = candidates[self.visits_[candidates] >= selection.visit_threshold]
+        return threshold_totals(np.sum(self.ingredients_[:, selected], axis=1))
+
 
-    return visits, contributions, deviations
+# Builds the threshold index of a measurement from all of its callpaths.
+def get_threshold_index(info: measurement_info, load=load_measurement):
+    return threshold_index(get_filtered_data(info, None, load))
 
 
-def deviation_score(info: measurement_info, selection: data_selection, filtered_data):
-    visits, contributions, deviations = filtered_data
-    if not deviations:
+def deviation_score(info: measurement_info, selection: data_selection, data: filtered_data):
+    if len(data) == 0:
         warn(f"Missing data for measurement {info.key()}")
         return np.inf
-    return deviation_score_from_data(visits, contributions, deviations, selection)
+    return data.mean()
 
 
 def sensitivity_score(
     noisy_info: measurement_info,
     ref_info: measurement_info,
     selection: data_selection,
-    noisy_data,
-    ref_data,
+    noisy_data: filtered_data,
+    ref_data: filtered_data,
 ):
-    noisy_vis, noisy_con, noisy_dev = noisy_data
-    ref_vis, ref_con, ref_dev = ref_data
-
-    if not noisy_dev:
+    if len(noisy_data) == 0:
         warn(f"Missing data for measurement {noisy_info.key()}")
         return np.inf
 
-    if not ref_dev:
+    if len(ref_data) == 0:
         warn(f"Missing data for measurement {ref_info.key()}")
         return np.inf
 
-    def mu_sigma_sq(dev, con):
-        sum = 0.0
-        total_contrib = 0.0
-        for d, c in zip(dev, con):
-            sum += np.sum(d) / len(d) * c
-            total_contrib += c
-        mu = sum / total_contrib
-
-        sum = 0.0
-        for d, c in zip(dev, con):
-            sum += np.sum([(x - mu) ** 2 for x in d]) / len(d) * c
-        sigma_sq = sum / total_contrib
-        return mu, sigma_sq
+    mu_noisy, sigma_sq_noisy = noisy_data.moments()
+    mu_ref, sigma_sq_ref = ref_data.moments()
+
+    sigma_sq = sigma_sq_noisy + sigma_sq_ref
+    if sigma_sq == 0:
+        # Without any variance, e.g. because no selected callpath contributes, any difference of the means is infinite.
+        return 0.0 if mu_noisy == mu_ref else np.inf
+    return abs(mu_noisy - mu_ref) / np.sqrt(sigma_sq)
+
+
+# Scores noisy measurements against their common NO_NOISE reference, which is only loaded and filtered once.
+def score_reference_group(infos, ref_info, selection: data_selection, load=load_measurement):
+    ref_data = get_filtered_data(ref_info, selection, load)
+    return {
+        info.key(): score(info, ref_info, selection, ref_data, get_filtered_data(info, selection, load))
+        for info in infos
+    }
+
+
+# Scores noisy measurements against their common NO_NOISE reference for each selection, where the selections only
+# differ in their thresholds. Every measurement is loaded once to build its threshold index, from which all selections
+# are scored.
+def sweep_reference_group(infos, ref_info, selections):
+    ref_index = get_threshold_index(ref_info)
+    indices = [(info, get_threshold_index(info)) for info in infos]
+
+    sweep = []
+    for selection in selections:
+        ref_totals = ref_index.totals(selection)
+        sweep.append(
+            {
+                info.key(): score(info, ref_info, selection, ref_totals, index.totals(selection))
+                for info, index in indices
+            }
+        )
+    return sweep
+
+
+# Calls fn(infos, ref_info, *args) for the noisy measurements of each NO_NOISE reference and yields the results.
+# With more than one job, the groups are distributed across worker processes and yielded as they complete.
+def map_reference_groups(fn, noisy, ref, args, progress=False, jobs=1):
+    groups = {}
+    for info in noisy.values():
+        groups.setdefault(info.noiseless_key(), []).append(info)
+
+    for ref_key in list(groups):
+        if ref_key not in ref:
+            warn(f"Missing reference measurement {ref_key}")
+            del groups[ref_key]
+
+    if jobs <= 1:
+        for ref_key, infos in tqdm(groups.items(), disable=not progress):
+            yield fn(infos, ref[ref_key], *args)
+        return
+
+    with ProcessPoolExecutor(jobs) as exec:
+        futures = [exec.submit(fn, infos, ref[ref_key], *args) for ref_key, infos in groups.items()]
+        for future in tqdm(as_completed(futures), total=len(futures), disable=not progress):
+            yield future.result()
+
+
+# Returns the cached scores of each selection and the noisy measurements that have to be scored because at least one
+# of their scores is missing from the cache.
+def cached_scores(noisy, ref, selections, cache):
+    sweep = [{} for _ in selections]
+    if cache is None:
+        return sweep, noisy
+
+    missing = {}
+    for key, info in noisy.items():
+        ref_info = ref.get(info.noiseless_key())
+        if ref_info is None:
+            missing[key] = info
+            continue
+        hits = [cache.get(cache.score_key(info, ref_info, selection)) for selection in selections]
+        if any(hit is None for hit in hits):
+            missing[key] = info
+            continue
+        for scores, hit in zip(sweep, hits):
+            scores[key] = hit
+    return sweep, missing
+
+
+def cache_scores(noisy, ref, selections, sweep, cache):
+    if cache is None:
+        return
+    for selection, scores in zip(selections, sweep):
+        for key, scr in scores.items():
+            cache.put(cache.score_key(noisy[key], ref[noisy[key].noiseless_key()], selection), scr, evict=False)
+    cache.trim()
+
+
+# Scores all noisy measurements against their NO_NOISE references.
+# The noisy measurements are grouped by their reference so that each reference is only loaded and filtered once.
+# Scores found in the cache are not calculated again.
+def score_measurements(
+    noisy, ref, selection: data_selection, progress=False, jobs=1, cache=None, load=load_measurement
+):
+    (scores,), missing = cached_scores(noisy, ref, [selection], cache)
+    new_scores = {}
+    for group_scores in map_reference_groups(score_reference_group, missing, ref, (selection, load), progress, jobs):
+        new_scores.update(group_scores)
+    cache_scores(noisy, ref, [selection], [new_scores], cache)
+
+    scores.update(new_scores)
+    return scores
+
 
-    mu_noisy, sigma_sq_noisy = mu_sigma_sq(noisy_dev, noisy_con)
-    mu_ref, sigma_sq_ref = mu_sigma_sq(ref_dev, ref_con)
+# Scores all noisy measurements against their NO_NOISE references for each selection, where the selections only differ
+# in their thresholds. Returns the scores of each selection in the same order.
+def sweep_measurements(noisy, ref, selections, progress=False, jobs=1, cache=None):
+    sweep, missing = cached_scores(noisy, ref, selections, cache)
+    new_sweep = [{} for _ in selections]
+    for group_sweep in map_reference_groups(sweep_reference_group, missing, ref, (selections,), progress, jobs):
+        for scores, group_scores in zip(new_sweep, group_sweep):
+            scores.update(group_scores)
+    cache_scores(noisy, ref, selections, new_sweep, cache)
 
-    return abs(mu_noisy - mu_ref) / np.sqrt(sigma_sq_noisy + sigma_sq_ref)
+    for scores, new_scores in zip(sweep, new_sweep):
+        scores.update(new_scores)
+    return sweep
 
 
 def print_cli_formatted(scores, selection):
@@ -200,6 +537,60 @@ def print_tabular(scores, selection):
     print("\\end{table}")
 
 
+# Fields of the machine-readable output formats, one record per ranked measurement
+record_fields = [
+    "contrib_threshold",
+    "visit_threshold",
+    "rank",
+    "benchmark",
+    "system",
+    "noise_pattern",
+    "counter",
+    "resilience",
+    "deviation",
+    "deviation_noisy",
+    "deviation_ref",
+    "susceptibility",
+]
+
+
+def score_records(scores, selection):
+    place = 1
+    for key, sc in sorted(scores.items(), key=lambda it: it[1].rel_resilience, reverse=True):
+        info = measurement_info.from_key(key)
+        yield {
+            "contrib_threshold": selection.contrib_threshold,
+            "visit_threshold": selection.visit_threshold,
+            "rank": place,
+            "benchmark": info.benchmark,
+            "system": info.system,
+            "noise_pattern": info.noise_pattern,
+            "counter": info.counter,
+            "resilience": float(sc.rel_resilience),
+            "deviation": float(sc.deviation()),
+            "deviation_noisy": float(sc.dev_noisy),
+            "deviation_ref": float(sc.dev_ref),
+            "susceptibility": float(sc.susceptibility),
+        }
+        place += 1
+
+
+# Prints one JSON object per line. Infinite scores indicate missing data and are written as null.
+def print_json(scores, selection):
+    for record in score_records(scores, selection):
+        record = {k: None if isinstance(v, float) and not np.isfinite(v) else v for k, v in record.items()}
+        print(json.dumps(record), flush=True)
+
+
+def print_csv(scores, selection, header=True):
+    writer = csv.DictWriter(sys.stdout, record_fields)
+    if header:
+        writer.writeheader()
+    for record in score_records(scores, selection):
+        writer.writerow(record)
+    sys.stdout.flush()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
 
@@ -221,6 +612,34 @@ def main() -> None:
     parser.add_argument(
         "--tex",
         action="store_true",
+        help="Same as --format tex",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["text", "tex", "json", "csv"],
+        default="text",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        default=1,
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "--cache-size",
+        action="store",
+        type=parse_size,
+        default=default_cache_size,
+        help="Size limit of the score cache in result/.cache, e.g. 512M. 0 disables the cache.",
+    )
+    parser.add_argument(
+        "--sweep",
+        nargs=2,
+        metavar=("CONTRIBUTIONS", "VISITS"),
+        help="Rank for every pair of the comma-separated contribution and visit thresholds instead of -c and -v",
     )
 
     args = parser.parse_args()
@@ -243,18 +662,39 @@ def main() -> None:
         else:
             noisy[key] = info
 
-    scores = {}
-    for key in tqdm(noisy.keys()):
-        info_ref = measurement_info.from_key(key)
-        scores[key] = score(noisy[key], ref[info_ref.noiseless_key()], selection)
-
-    sgp = score_group(scores)
-
-    if args.tex:
-        print_tabular(sgp.scores, selection)
+    cache = result_cache(os.path.join(args.experiment_root, "result", ".cache"), args.cache_size)
+
+    if args.sweep:
+        contributions = [float(c) for c in args.sweep[0].split(",")]
+        visits = [int(v) for v in args.sweep[1].split(",")]
+        selections = []
+        for contrib_threshold in contributions:
+            for visit_threshold in visits:
+                sel = copy(selection)
+                sel.contrib_threshold = contrib_threshold
+                sel.visit_threshold = visit_threshold
+                selections.append(sel)
+        sweep = sweep_measurements(noisy, ref, selections, progress=True, jobs=args.jobs, cache=cache)
     else:
-        print_cli_formatted(sgp.scores, selection)
+        selections = [selection]
+        sweep = [score_measurements(noisy, ref, selection, progress=True, jobs=args.jobs, cache=cache)]
+
+    output_format = "tex" if args.tex else args.format
+    for i, (sel, scores) in enumerate(zip(selections, sweep)):
+        sgp = score_group(scores)
+
+        if output_format == "tex":
+            print_tabular(sgp.scores, sel)
+        elif output_format == "json":
+            print_json(sgp.scores, sel)
+        elif output_format == "csv":
+            print_csv(sgp.scores, sel, header=i == 0)
+        else:
+            print_cli_formatted(sgp.scores, sel)
 
 
 if __name__ == "__main__":
-    main()
+    # Run main from the imported module, so that cached results are pickled under its name instead of __main__.
+    import norc.core.score
+
+    norc.core.score.main()
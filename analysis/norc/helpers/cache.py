@@ -0,0 +1,201 @@
+# This file is part of the NORC software
+#
+# Copyright (c) 2025, Technical University of Darmstadt, Germany
+#
+# This software may be modified and distributed under the terms of a BSD-style license.
+# See the LICENSE file in the base directory for details.
+
+import os
+import pickle
+import hashlib
+from threading import Lock, get_ident
+
+from norc.helpers.util import measurement_info, data_selection, measurement_size, warn
+
+# Bumped whenever the cached objects or the calculations behind them change, which invalidates all entries.
+cache_version = 3
+
+default_cache_size = 256 << 20
+
+
+class result_cache:
+    """Scores and prepared plots of an experiment, kept across sessions in result/.cache.
+
+    Entries are keyed by the fingerprints of the measurement files they were calculated from and by the settings they
+    depend on, so re-analyzed measurements or changed settings never hit stale entries. Once the cache grows beyond
+    its size limit, the least recently used entries are evicted. A size limit of 0 disables the cache.
+
+    Several processes may share the directory, e.g. a GUI session and norc_rank. Each process tracks the entries it
+    has seen, and the directory is scanned again before anything is evicted, so entries of other processes count
+    towards the size limit as well.
+    """
+
+    def __init__(self, directory, max_size=default_cache_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.mutex_ = Lock()
+        self.fingerprints_ = {}
+
+        # Size and last use of each entry. Entries are touched when used, so the modification time orders them.
+        self.entries_ = self.scan_() if self.max_size > 0 else {}
+
+    # Reads the size and last use of all entries in the directory, whichever process wrote them.
+    def scan_(self):
+        entries = {}
+        try:
+            with os.scandir(self.directory) as it:
+                for f in it:
+                    if not f.name.endswith(".pickle"):
+                        continue
+                    try:
+                        stat = f.stat()
+                    except FileNotFoundError:
+                        # Evicted by another process in the meantime
+                        continue
+                    entries[f.name] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return entries
+
+    # The cache can be passed to worker processes, each of which gets its own lock.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["mutex_"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mutex_ = Lock()
+
+    # Identifies the contents of a measurement file without reading it. Results are written to a staging directory
+    # that is renamed when complete, so a re-analyzed measurement always gets a new inode and modification time.
+    def fingerprint_(self, path):
+        if path not in self.fingerprints_:
+            stat = os.stat(path)
+            self.fingerprints_[path] = (
+                os.path.basename(path),
+                stat.st_ino,
+                stat.st_mtime_ns,
+                measurement_size(path)[1],
+            )
+        return self.fingerprints_[path]
+
+    def measurement_key_(self, info: measurement_info):
+        return (info.key(), tuple(self.fingerprint_(p) for p in info.file_paths))
+
+    @staticmethod
+    def selection_key_(selection: data_selection):
+        return (
+            selection.lump_benchmarks,
+            selection.lump_systems,
+            selection.lump_resources,
+            selection.lump_params,
+            selection.lump_noise,
+            float(selection.visit_threshold),
+            float(selection.contrib_threshold),
+        )
+
+    def score_key(self, noisy_info: measurement_info, ref_info: measurement_info, selection: data_selection):
+        return (
+            "score",
+            self.measurement_key_(noisy_info),
+            self.measurement_key_(ref_info),
+            self.selection_key_(selection),
+        )
+
+    # Only the settings that prepare_plot depends on are part of the key.
+    def plot_key(self, settings, info: measurement_info):
+        return (
+            "plot",
+            self.measurement_key_(info),
+            self.selection_key_(settings.selection),
+            settings.plot_mode,
+            settings.bin_spread,
+            settings.n_bands,
+            settings.deviation_cutoff,
+        )
+
+    @staticmethod
+    def file_name_(key):
+        return hashlib.sha1(repr((cache_version, key)).encode()).hexdigest() + ".pickle"
+
+    def get(self, key):
+        if self.max_size <= 0:
+            return None
+        name = self.file_name_(key)
+        with self.mutex_:
+            if name not in self.entries_:
+                return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            # Entries may be evicted by other sessions
+            with self.mutex_:
+                self.entries_.pop(name, None)
+            return None
+        except Exception:
+            # Entries that can't be read anymore, e.g. because a class they hold was renamed, are only recalculated.
+            with self.mutex_:
+                self.entries_.pop(name, None)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        try:
+            os.utime(path)
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return value
+        with self.mutex_:
+            if name in self.entries_:
+                self.entries_[name] = (self.entries_[name][0], mtime)
+        return value
+
+    # Writers of many entries at once pass evict=False and call trim afterwards, which scans the directory only once.
+    def put(self, key, value, evict=True):
+        if self.max_size <= 0:
+            return
+        name = self.file_name_(key)
+        path = os.path.join(self.directory, name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Entries are written under a temporary name so that readers never see partial files.
+            tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+            stat = os.stat(path)
+        except OSError as e:
+            warn(f"Could not write to the cache in {self.directory}: {e}")
+            return
+
+        with self.mutex_:
+            self.entries_[name] = (stat.st_size, stat.st_mtime_ns)
+            if evict and sum(s for s, _ in self.entries_.values()) > self.max_size:
+                self.evict_()
+
+    # Evicts the least recently used entries until the directory fits the size limit, including entries of other
+    # processes that this one hasn't seen.
+    def trim(self):
+        if self.max_size <= 0:
+            return
+        with self.mutex_:
+            self.evict_()
+
+    # Removes the least recently used entries of the directory until the cache fits its size limit.
+    def evict_(self):
+        self.entries_ = self.scan_()
+        size = sum(s for s, _ in self.entries_.values())
+        for name, (entry_size, _) in sorted(self.entries_.items(), key=lambda it: it[1][1]):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            del self.entries_[name]
+            size -= entry_size
@@ -0,0 +1,177 @@
+# This file is part of the NORC software
+#
+# Copyright (c) 2025, Technical University of Darmstadt, Germany
+#
+# This software may be modified and distributed under the terms of a BSD-style license.
+# See the LICENSE file in the base directory for details.
+
+import io
+import gzip
+import zlib
+import struct
+import tarfile
+import numpy as np
+from xml.etree import ElementTree
+
+from pycubexr.parsers.anchor_xml_parser import parse_anchor_xml
+
+from norc.helpers.util import warn
+
+INDEX_HEADER = b"CUBEX.INDEX"
+DATA_HEADER = b"CUBEX.DATA"
+ZDATA_HEADER = b"ZCUBEX.DATA"
+
+# Storage types of the metrics with a single value per cnode and location, as cubelib writes them.
+metric_dtypes = {
+    "CHAR": np.uint8,
+    "DOUBLE": np.float64,
+    "FLOAT": np.float64,
+    "INT": np.int32,
+    "INT8": np.int8,
+    "INT16": np.int16,
+    "INT32": np.int32,
+    "INT64": np.int64,
+    "INTEGER": np.int64,
+    "SHORT INT": np.int16,
+    "SIGNED INT": np.int32,
+    "SIGNED INTEGER": np.int64,
+    "SIGNED SHORT INT": np.int16,
+    "UINT8": np.uint8,
+    "UINT16": np.uint16,
+    "UINT32": np.uint32,
+    "UINT64": np.uint64,
+    "UNSIGNED INT": np.uint32,
+    "UNSIGNED INTEGER": np.uint64,
+    "UNSIGNED SHORT INT": np.uint16,
+}
+
+# Largest uint64 that survives the conversion to double and back, which cubelib applies to these values.
+max_uint64_double = 0xFFFF_FFFF_FFFF_FBFF
+
+
+# CubeWriter 4.8 writes tar headers with wrong checksums. The stored checksum of each non-empty header block is
+# replaced with the computed one before the block is parsed.
+class lenient_tarinfo(tarfile.TarInfo):
+    @classmethod
+    def frombuf(cls, buf, encoding, errors):
+        if len(buf) == tarfile.BLOCKSIZE and buf.count(tarfile.NUL) != tarfile.BLOCKSIZE:
+            checksum = 256 + sum(struct.unpack_from("148B8x356B", buf))
+            buf = buf[:148] + b"%07o\0" % checksum + buf[156:]
+        return super().frombuf(buf, encoding, errors)
+
+
+# Decompresses the data of a metric written as zlib compressed chunks. The header holds the number of chunks and an
+# entry of uncompressed position, compressed position and compressed size for each of them.
+def decompress_data(data, endianness):
+    data = memoryview(data)
+    n_chunks = int(np.frombuffer(data, dtype=endianness + "i8", count=1)[0])
+    entries = np.frombuffer(data, dtype=endianness + "i8", count=3 * n_chunks, offset=8).reshape(n_chunks, 3)
+    pos = 8 * (1 + 3 * n_chunks)
+    chunks = []
+    for size in entries[:, 2].tolist():
+        if size == 0:
+            continue
+        chunks.append(zlib.decompress(data[pos : pos + size]))
+        pos += size
+    return b"".join(chunks)
+
+
+class cubex_profile:
+    """Call tree and values of selected metrics of a cubex profile, read in a single pass over the archive.
+
+    pycubexr opens and decompresses each metric separately, which costs several seeks per metric.
+    This reader streams through the archive once and keeps the data members of all requested metrics.
+    Uncompressed values are exposed as NumPy views of the member contents, compressed ones are decompressed first.
+    Only metrics with a single value per cnode and location are supported.
+    """
+
+    def __init__(self, path, metric_names):
+        self.path = path
+        self.anchor = None
+        self.metrics_ = {}
+        self.metric_names = metric_names
+
+        members = {}
+        try:
+            self.read_members_(members, tarfile.TarInfo)
+        except tarfile.ReadError:
+            warn(f"Reading {path} without checking header checksums. This is expected for files of CubeWriter 4.8.")
+            members.clear()
+            self.read_members_(members, lenient_tarinfo)
+
+        if self.anchor is None:
+            raise ValueError(f"{path} does not contain an anchor.xml")
+
+        # For each metric, the ids of the cnodes it has values for and a (cnodes x locations) view of these values.
+        self.cnode_ids = {}
+        self.values = {}
+        for name in metric_names:
+            metric = self.metrics_[name]
+            cnode_ids, values = self.parse_metric_(metric, members[f"{metric.id}.index"], members[f"{metric.id}.data"])
+            self.cnode_ids[name] = cnode_ids
+            self.values[name] = values
+
+    def parse_anchor_(self, anchor):
+        if not anchor.startswith(b"<?xml"):
+            # If it doesn't start with xml it is compressed
+            anchor = gzip.decompress(anchor)
+        self.anchor = parse_anchor_xml(ElementTree.parse(io.BytesIO(anchor)))
+        self.n_locations = len(self.anchor.system_tree_nodes[0].all_locations())
+
+        # The metric tree is walked without a recursive closure, which would keep the profile and its values alive in a
+        # reference cycle until the garbage collector runs.
+        stack = list(reversed(self.anchor.metrics))
+        while stack:
+            metric = stack.pop()
+            self.metrics_[metric.name] = metric
+            stack.extend(reversed(metric.childs))
+
+    # Reads the anchor and the index and data members of the selected metrics in a single sequential pass.
+    # Members preceding the anchor are kept until it is known which metrics they belong to.
+    def read_members_(self, members, tarinfo):
+        wanted = None
+        with tarfile.open(self.path, mode="r|*", tarinfo=tarinfo) as archive:
+            for member in archive:
+                if member.name == "anchor.xml":
+                    self.parse_anchor_(archive.extractfile(member).read())
+                    ids = {str(self.metrics_[name].id) for name in self.metric_names if name in self.metrics_}
+                    wanted = lambda name: name.split(".")[0] in ids
+                elif member.name.endswith((".index", ".data")) and (wanted is None or wanted(member.name)):
+                    members[member.name] = archive.extractfile(member).read()
+
+    def parse_metric_(self, metric, index, data):
+        if not index.startswith(INDEX_HEADER):
+            raise ValueError(f"Corrupt index for metric {metric.name} in {self.path}")
+
+        # The index starts with the number 1 encoded as an int which determines the endianness of index and data.
+        pos = len(INDEX_HEADER)
+        endianness = "<" if np.frombuffer(index, dtype="<i4", count=1, offset=pos)[0] == 1 else ">"
+        # Skip the version (short) and index type (char)
+        pos += 4 + 2 + 1
+        n_nodes = np.frombuffer(index, dtype=endianness + "i4", count=1, offset=pos)[0]
+        tree_indices = np.frombuffer(index, dtype=endianness + "i4", count=n_nodes, offset=pos + 4)
+        cnode_ids = np.fromiter(
+            (metric.tree_index_to_cid_map[i] for i in tree_indices.tolist()), dtype=np.int64, count=n_nodes
+        )
+
+        if metric.data_type not in metric_dtypes:
+            raise ValueError(f"Unsupported type {metric.data_type} of metric {metric.name} in {self.path}")
+        dtype = np.dtype(metric_dtypes[metric.data_type]).newbyteorder(endianness)
+
+        if data.startswith(ZDATA_HEADER):
+            data = decompress_data(memoryview(data)[len(ZDATA_HEADER) :], endianness)
+        elif data.startswith(DATA_HEADER):
+            data = memoryview(data)[len(DATA_HEADER) :]
+        else:
+            raise ValueError(f"Corrupt data for metric {metric.name} in {self.path}")
+
+        values = np.frombuffer(data, dtype=dtype)
+        if metric.data_type in ("UINT64", "UNSIGNED INTEGER") and np.any(values > max_uint64_double):
+            values = np.where(values > max_uint64_double, np.uint64(0), values)
+
+        if len(values) != n_nodes * self.n_locations:
+            raise ValueError(f"Unexpected number of values for metric {metric.name} in {self.path}")
+        return cnode_ids, np.reshape(values, (n_nodes, self.n_locations))
+
+    def root_cnodes(self):
+        return self.anchor.cnodes
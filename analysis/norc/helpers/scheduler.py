@@ -0,0 +1,95 @@
+# This file is part of the NORC software
+#
+# Copyright (c) 2025, Technical University of Darmstadt, Germany
+#
+# This software may be modified and distributed under the terms of a BSD-style license.
+# See the LICENSE file in the base directory for details.
+
+import heapq
+import itertools
+from concurrent.futures import Future
+from threading import Condition, Thread
+
+
+class priority_scheduler:
+    """Runs tasks in worker threads, the ones with the lowest priority value first.
+
+    Tasks with the same priority run in the order they were submitted. Each task is submitted under a key and a version.
+    Submitting a key that is still queued returns the queued task, which is moved up if the new priority is higher, so
+    nothing is calculated twice. Once the results of older versions are no longer needed, cancel_before drops their
+    queued tasks, so that new requests don't have to wait for them.
+    """
+
+    def __init__(self, n_workers=1):
+        self.cv_ = Condition()
+        # Heap of [priority, sequence number, key, version, future, fn, args]. Entries that were moved up or cancelled
+        # stay in the heap and are skipped because they are no longer the queued entry of their key.
+        self.queue_ = []
+        self.queued_ = {}
+        self.sequence_ = itertools.count()
+        self.shutdown_ = False
+        self.workers_ = [Thread(target=self.work_, daemon=True) for _ in range(max(1, n_workers))]
+        for worker in self.workers_:
+            worker.start()
+
+    def submit(self, key, priority, version, fn, *args) -> Future:
+        with self.cv_:
+            entry = self.queued_.get(key)
+            if entry is not None and entry[3] == version:
+                if priority >= entry[0]:
+                    return entry[4]
+                future = entry[4]
+            else:
+                if entry is not None:
+                    entry[4].cancel()
+                future = Future()
+
+            entry = [priority, next(self.sequence_), key, version, future, fn, args]
+            self.queued_[key] = entry
+            heapq.heappush(self.queue_, entry)
+            self.cv_.notify()
+            return future
+
+    # Cancels all queued tasks of versions before the given one. Tasks that are already running are not interrupted.
+    def cancel_before(self, version):
+        with self.cv_:
+            for key, entry in list(self.queued_.items()):
+                if entry[3] < version:
+                    del self.queued_[key]
+                    entry[4].cancel()
+            self.queue_ = [entry for entry in self.queue_ if self.queued_.get(entry[2]) is entry]
+            heapq.heapify(self.queue_)
+
+    # Cancels all queued tasks and waits for the running ones to finish.
+    def shutdown(self):
+        with self.cv_:
+            self.shutdown_ = True
+            for entry in self.queued_.values():
+                entry[4].cancel()
+            self.queued_.clear()
+            self.queue_.clear()
+            self.cv_.notify_all()
+        for worker in self.workers_:
+            worker.join()
+
+    def work_(self):
+        while True:
+            with self.cv_:
+                while not self.queue_ and not self.shutdown_:
+                    self.cv_.wait()
+                if self.shutdown_:
+                    return
+                entry = heapq.heappop(self.queue_)
+                _, _, key, _, future, fn, args = entry
+                if self.queued_.get(key) is not entry:
+                    continue
+                del self.queued_[key]
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
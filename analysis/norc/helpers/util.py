@@ -6,9 +6,15 @@
 # See the LICENSE file in the base directory for details.
 
 import os
+import json
 import pickle
+import shutil
 import copy
 import re
+import functools
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
 from matplotlib import ticker
 from termcolor import colored
 
@@ -62,7 +68,8 @@ class measurement_info:
     def noiseless_key(self):
         return (self.benchmark, self.system, "NO_NOISE", self.counter)
 
-    def from_key(self, k):
+    @staticmethod
+    def from_key(k):
         info = measurement_info()
         info.benchmark = k[0]
         info.system = k[1]
@@ -71,13 +78,18 @@ class measurement_info:
         return info
 
 
+# Accepts the items of a comma-separated list, or everything if the list is empty.
+# This is a class rather than a closure so that selections can be passed to worker processes.
+class comma_separated_filter:
+    def __init__(self, items):
+        self.items = items.split(",") if len(items) > 0 else None
+
+    def __call__(self, x):
+        return self.items is None or x in self.items
+
+
 class experiment_filter:
     def __init__(self, benchmarks="", systems="", noise_patterns="", counters=""):
-        def comma_separated_filter(items):
-            if len(items) > 0:
-                return lambda x: x in items.split(",")
-            return lambda x: True
-
         # ALL_NOISE is loaded as its own result and should therefore be spared by the filters. Groupings will take care of it.
         if noise_patterns:
             noise_patterns += ",ALL_NOISE"
@@ -122,6 +134,215 @@ class callpath_data:
         self.contribution = 0
 
 
+# Number of neighboring bins the deviation histograms are smoothed over
+histogram_bin_spread = 20
+# Bin spreads whose histograms are stored with each measurement, so that plots with these spreads don't need to
+# read the deviations. The bins depend on the spread, so each spread has its own histograms.
+histogram_bin_spreads = (10, 20, 40)
+
+
+# Returns the names of the offsets, bins and counts columns of the stored histograms for a bin spread.
+# The default spread keeps the names from before histograms were stored for several spreads.
+def histogram_columns(bin_spread=histogram_bin_spread):
+    suffix = "" if bin_spread == histogram_bin_spread else f"_{bin_spread}"
+    return [f"hist_offsets{suffix}", f"hist_bins{suffix}", f"hist_counts{suffix}"]
+
+
+# Returns the edges of the bins deviations are counted in. Bin widths increase with higher deviations.
+# The edges are shared between all callers and therefore read-only.
+@functools.lru_cache(maxsize=None)
+def deviation_bins(bin_spread=histogram_bin_spread):
+    bins = np.concatenate(
+        [
+            np.arange(0, 100, 0.25),
+            np.arange(101, 300 + bin_spread, 1),
+            np.arange(300 + bin_spread, 1000 + bin_spread, 10),
+        ]
+    )
+    bins.setflags(write=False)
+    return bins
+
+
+# Returns which deviations fall into the bins and the bin of each of those.
+# Bins are closed on the left except for the last one, which matches np.histogram.
+def bin_deviations(bins, deviations):
+    valid = (deviations >= bins[0]) & (deviations <= bins[-1])
+    bin_ids = np.minimum(np.searchsorted(bins, deviations[valid], side="right") - 1, len(bins) - 2)
+    return valid, bin_ids
+
+
+# Returns the positions of all values of the selected segments values[offsets[i] : offsets[i + 1]], in order,
+# along with the length of each segment.
+def segment_positions(offsets, indices):
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    ends = np.cumsum(lengths)
+    positions = np.arange(ends[-1] if len(ends) > 0 else 0) + np.repeat(starts - (ends - lengths), lengths)
+    return positions, lengths
+
+
+# Reduces each segment values[offsets[i] : offsets[i + 1]] with a ufunc. Empty segments are set to 0.
+def reduce_segments(ufunc, values, offsets):
+    result = np.zeros(len(offsets) - 1, dtype=values.dtype)
+    non_empty = offsets[1:] > offsets[:-1]
+    if np.any(non_empty):
+        # Empty segments don't contain any values, so leaving them out keeps the remaining segments intact.
+        result[non_empty] = ufunc.reduceat(values, offsets[:-1][non_empty])
+    return result
+
+
+# Splits consecutive segments into ranges [begin, end) whose total size doesn't exceed a limit.
+# Every range contains at least one segment, so a single segment may exceed the limit on its own.
+def segment_ranges(sizes, limit):
+    if limit <= 0:
+        return [(0, len(sizes))]
+
+    ranges = []
+    begin = 0
+    size = 0
+    for i, n in enumerate(sizes):
+        if i > begin and size + n > limit:
+            ranges.append((begin, i))
+            begin = i
+            size = 0
+        size += n
+    ranges.append((begin, len(sizes)))
+    return ranges
+
+
+# Upper bound of the temporary memory summary_builder.add needs per deviation, in bytes
+summary_bytes_per_deviation = 64
+
+
+class summary_builder:
+    """Calculates the summaries of measurement_data for consecutive chunks of callpaths.
+
+    The summaries of a callpath only depend on its own deviations, so the deviations of all callpaths never need to be
+    in memory at once. The results are the same as if all callpaths were summarized together.
+    """
+
+    def __init__(self):
+        self.counts_ = []
+        self.sums_ = []
+        self.sumsqs_ = []
+        self.maxima_ = []
+        # Number of non-empty bins, bins and counts of the histograms of each spread
+        self.histograms_ = {spread: ([], [], []) for spread in histogram_bin_spreads}
+
+    # Adds the next callpaths, given their deviations and the number of deviations of each of them.
+    def add(self, deviations, counts):
+        # Summaries are calculated from the stored values so that they match the deviations exactly.
+        devs = np.asarray(deviations, dtype=np.float64)
+        offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        self.counts_.append(np.asarray(counts, dtype=np.int64))
+        self.sums_.append(reduce_segments(np.add, devs, offsets))
+        self.sumsqs_.append(reduce_segments(np.add, devs * devs, offsets))
+        # Deviations are never negative, so 0 also serves as the maximum of empty callpaths.
+        self.maxima_.append(np.maximum(reduce_segments(np.maximum, devs, offsets), 0))
+
+        # All histograms of a spread are counted at once by binning each deviation together with its callpath.
+        callpaths = np.repeat(np.arange(len(counts)), counts)
+        for spread in histogram_bin_spreads:
+            bins = deviation_bins(spread)
+            n_bins = len(bins) - 1
+            valid, bin_ids = bin_deviations(bins, devs)
+            keys, hist_counts = np.unique(callpaths[valid] * n_bins + bin_ids, return_counts=True)
+            lengths = np.bincount(keys // n_bins, minlength=len(counts))
+            columns = [lengths, (keys % n_bins).astype(np.int32), hist_counts]
+            for parts, column in zip(self.histograms_[spread], columns):
+                parts.append(column)
+
+    # Sets the summaries of all callpaths added so far on a measurement.
+    def apply(self, data):
+        join = lambda parts, dtype: np.concatenate([np.zeros(0, dtype=dtype)] + parts)
+        data.counts = join(self.counts_, np.int64)
+        data.sums = join(self.sums_, np.float64)
+        data.sumsqs = join(self.sumsqs_, np.float64)
+        data.maxima = join(self.maxima_, np.float64)
+        for spread, (lengths, bins, counts) in self.histograms_.items():
+            offsets = np.concatenate([[0], np.cumsum(join(lengths, np.int64))])
+            for c, column in zip(histogram_columns(spread), [offsets, join(bins, np.int32), join(counts, np.int64)]):
+                setattr(data, c, column)
+
+
+class measurement_data:
+    """Columnar deviations of all callpaths of a measurement.
+
+    The deviations of callpath i are deviations[offsets[i] : offsets[i + 1]] and its name is names[name_ids[i]].
+    Loaded measurements memory-map their deviations, so slicing them doesn't copy any data.
+
+    Alongside the deviations, each callpath has mergeable summaries that suffice for scores and plots:
+    the number, sum, sum of squares and maximum of its deviations and their histograms on deviation_bins() for each
+    of the histogram_bin_spreads. Histograms are stored sparsely, the non-empty bins of callpath i being
+    hist_bins[hist_offsets[i] : hist_offsets[i + 1]] for the default spread (see histogram_columns for the others).
+    """
+
+    # File name of each column within a measurement's directory
+    columns = ["names", "name_ids", "visits", "contributions", "offsets", "deviations"]
+    summary_columns = ["counts", "sums", "sumsqs", "maxima"] + [
+        c for spread in histogram_bin_spreads for c in histogram_columns(spread)
+    ]
+
+    def __init__(self, names, name_ids, visits, contributions, offsets, deviations):
+        self.names = names
+        self.name_ids = name_ids
+        self.visits = visits
+        self.contributions = contributions
+        self.offsets = offsets
+        self.deviations = deviations
+
+    def __len__(self):
+        return len(self.visits)
+
+    def callpath_deviations(self, i):
+        return self.deviations[self.offsets[i] : self.offsets[i + 1]]
+
+    # Returns the offsets, bins and counts of the stored histograms for a bin spread.
+    def histograms(self, bin_spread=histogram_bin_spread):
+        return [getattr(self, c) for c in histogram_columns(bin_spread)]
+
+    # Returns the dense histogram of callpath i.
+    def histogram(self, i, bin_spread=histogram_bin_spread):
+        offsets, bins, counts = self.histograms(bin_spread)
+        begin, end = offsets[i], offsets[i + 1]
+        return np.bincount(bins[begin:end], weights=counts[begin:end], minlength=len(deviation_bins(bin_spread)) - 1)
+
+    # Calculates the summaries of all callpaths from their deviations.
+    def summarize(self):
+        summaries = summary_builder()
+        summaries.add(self.deviations, np.diff(self.offsets))
+        summaries.apply(self)
+
+    @staticmethod
+    def from_callpaths(callpaths):
+        names = counted_set()
+        for cp in callpaths:
+            names.insert(cp.name)
+        lengths = [len(cp.deviations) for cp in callpaths]
+        data = measurement_data(
+            np.array(names.ordered_elements(), dtype=str),
+            np.array([names.counts[cp.name] for cp in callpaths], dtype=np.int32),
+            np.array([cp.visits for cp in callpaths], dtype=np.float64),
+            np.array([cp.contribution for cp in callpaths], dtype=np.float64),
+            np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]),
+            np.concatenate(
+                [np.zeros(0, dtype=np.float32)] + [np.asarray(cp.deviations, dtype=np.float32) for cp in callpaths]
+            ),
+        )
+        data.summarize()
+        return data
+
+    def to_callpaths(self):
+        callpaths = []
+        for i in range(len(self)):
+            cp = callpath_data(str(self.names[self.name_ids[i]]))
+            cp.deviations = self.callpath_deviations(i)
+            cp.visits = self.visits[i]
+            cp.contribution = self.contributions[i]
+            callpaths.append(cp)
+        return callpaths
+
+
 class counted_set:
     def __init__(self):
         self.current_count = 0
@@ -171,48 +392,110 @@ def sorted_index_map(l, key=None, reverse=False, elem_transform=lambda x: x):
     return mp
 
 
-def available_measurements(experiment_dir, selection: data_selection):
-    # Items can be excluded by prepending a ".".
-    flt_is_pickle = lambda f: f.name.endswith(".pickle") and not f.name.startswith(".")
-    plt_infs = {}
-    # f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric.name}.pickle"
-    for meas in filter(flt_is_pickle, os.scandir(experiment_dir)):
-        components = meas.name.split(".")
-        p = measurement_info()
-
-        p.noise_pattern = components[2]
-        p.benchmark = components[0]
-        p.system = components[3]
-        p.counter = components[5].replace("PAPI_", "")
+# Returns the number of callpaths and the size in bytes of a stored measurement.
+# The number of callpaths of pickled measurements is unknown without loading them and returned as None.
+def measurement_size(path):
+    if path.endswith(".pickle"):
+        return None, os.path.getsize(path)
+    n_callpaths = len(np.load(os.path.join(path, "visits.npy"), mmap_mode="r"))
+    return n_callpaths, sum(f.stat().st_size for f in os.scandir(path))
+
+
+class experiment_catalog:
+    """Index of all measurements of an analyzed experiment.
+
+    norc_analyze writes the catalog next to the measurements so that they can be grouped and filtered in memory
+    without listing the directory. Experiments analyzed without a catalog are indexed from their file names instead.
+    """
+
+    file_name = "catalog.json"
+
+    def __init__(self, experiment_dir, entries=None):
+        self.experiment_dir = experiment_dir
+        if entries is None:
+            entries = self.read_()
+        self.entries = entries
+
+    @staticmethod
+    def entry(file, benchmark, params, noise_pattern, system, res_cfg, counter, callpaths=None, size=0):
+        return {
+            "file": file,
+            "benchmark": benchmark,
+            "params": params,
+            "noise_pattern": noise_pattern,
+            "system": system,
+            "res_cfg": res_cfg,
+            "counter": counter,
+            "callpaths": callpaths,
+            "bytes": size,
+        }
+
+    def read_(self):
+        try:
+            with open(os.path.join(self.experiment_dir, self.file_name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self.scan_()
+
+    def scan_(self):
+        # Items can be excluded by prepending a ".". Results of older versions are stored as pickles.
+        flt_is_measurement = lambda f: f.name.endswith((".dev", ".pickle")) and not f.name.startswith(".")
+        entries = []
+        # f"{info.benchmark}.{info.params}.{info.noise_pattern}.{info.system}.{info.res_cfg}.{metric.name}.dev"
+        for meas in filter(flt_is_measurement, os.scandir(self.experiment_dir)):
+            components = meas.name.split(".")
+            entries.append(self.entry(meas.name, *components[:6], *measurement_size(meas.path)))
+        return entries
+
+    def write(self):
+        path = os.path.join(self.experiment_dir, self.file_name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(path + ".tmp", path)
+
+    # Groups the measurements according to a selection. Returns a measurement_info for each resulting key.
+    def measurements(self, selection: data_selection):
+        plt_infs = {}
+        for e in self.entries:
+            p = measurement_info()
+
+            p.noise_pattern = e["noise_pattern"]
+            p.benchmark = e["benchmark"]
+            p.system = e["system"]
+            p.counter = e["counter"].replace("PAPI_", "")
+
+            # Ignore measurements that aren't accepted by the filter
+            if not selection.filter.check(p):
+                continue
+
+            # Noise lumping is a bit special since it's done during analysis and therefore just a matter of skipping all single-noise measurements.
+            if selection.lump_noise and p.noise_pattern not in ["NO_NOISE", "ALL_NOISE"]:
+                continue
+            if not selection.lump_noise and p.noise_pattern == "ALL_NOISE":
+                continue
+
+            if not selection.lump_params:
+                p.benchmark += f"({e['params']})"
+
+            if selection.lump_benchmarks:
+                p.benchmark = "ALL_BENCHMARKS"
+
+            if selection.lump_systems:
+                p.system = "ALL_SYSTEMS"
+
+            if not selection.lump_resources:
+                # Form separate "systems" for distinct resource configurations
+                p.system += f" ({e['res_cfg']})"
+
+            k = p.key()
+            if k not in plt_infs:
+                plt_infs[k] = p
+            plt_infs[k].file_paths.append(os.path.join(self.experiment_dir, e["file"]))
+        return plt_infs
 
-        # Ignore measurements that aren't accepted by the filter
-        if not selection.filter.check(p):
-            continue
 
-        # Noise lumping is a bit special since it's done during analysis and therefore just a matter of skipping all single-noise measurements.
-        if selection.lump_noise and p.noise_pattern not in ["NO_NOISE", "ALL_NOISE"]:
-            continue
-        if not selection.lump_noise and p.noise_pattern == "ALL_NOISE":
-            continue
-
-        if not selection.lump_params:
-            p.benchmark += f"({components[1]})"
-
-        if selection.lump_benchmarks:
-            p.benchmark = "ALL_BENCHMARKS"
-
-        if selection.lump_systems:
-            p.system = "ALL_SYSTEMS"
-
-        if not selection.lump_resources:
-            # Form separate "systems" for distinct resource configurations
-            p.system += f" ({components[4]})"
-
-        k = p.key()
-        if k not in plt_infs:
-            plt_infs[k] = p
-        plt_infs[k].file_paths.append(meas)
-    return plt_infs
+def available_measurements(experiment_dir, selection: data_selection):
+    return experiment_catalog(experiment_dir).measurements(selection)
 
 
 class NochrUnpickler(pickle.Unpickler):
@@ -223,19 +506,149 @@ class NochrUnpickler(pickle.Unpickler):
         return super().find_class(module, name)
 
 
+# Loads a measurement as measurement_data. Pickled lists of callpath_data written by older versions are converted.
 def load_measurement(path):
     try:
-        with open(path, "rb") as f:
-            unpickler = NochrUnpickler(f)
-            return unpickler.load()
+        if os.fspath(path).endswith(".pickle"):
+            with open(path, "rb") as f:
+                unpickler = NochrUnpickler(f)
+                return measurement_data.from_callpaths(unpickler.load())
+
+        # Only the deviations are memory-mapped. The per-callpath columns are small and loaded right away.
+        columns = {c: np.load(os.path.join(path, f"{c}.npy")) for c in measurement_data.columns if c != "deviations"}
+        # Plain array views of the mapping are cheaper to slice than np.memmap objects.
+        columns["deviations"] = np.asarray(np.load(os.path.join(path, "deviations.npy"), mmap_mode="r"))
+        data = measurement_data(**columns)
+
+        # Measurements written before summaries were stored have them calculated instead.
+        if not all(os.path.exists(os.path.join(path, f"{c}.npy")) for c in measurement_data.summary_columns):
+            data.summarize()
+            return data
+        for c in measurement_data.summary_columns:
+            setattr(data, c, np.load(os.path.join(path, f"{c}.npy")))
+        return data
     except Exception as e:
         print(f"Failed to load measurement {path}: {e}")
 
 
-def write_measurement(destination, obj):
+# Loads each measurement only once, for calculations that read the same measurements several times.
+# The measurements stay loaded for as long as the loader is kept.
+class measurement_loader:
+    def __init__(self):
+        self.loaded_ = {}
+
+    def __call__(self, path):
+        if path not in self.loaded_:
+            self.loaded_[path] = load_measurement(path)
+        return self.loaded_[path]
+
+
+default_measurement_cache_size = 1 << 30
+
+
+class measurement_cache:
+    """Most recently used measurements and entries derived from them, kept loaded for all calculations that read them.
+
+    The cache is called like load_measurement, and derived entries such as threshold indices are built through entry.
+    Entries are evicted least recently used first once their memory exceeds max_size. Only memory that an entry holds
+    counts towards it; memory-mapped deviations are paged in and out by the operating system. Arrays that a derived
+    entry shares with its measurement are counted for both, as they stay alive while either is kept. Entries larger
+    than max_size are built but not kept.
+    """
+
+    def __init__(self, max_size=default_measurement_cache_size):
+        self.max_size = max_size
+        self.mutex_ = Lock()
+        self.entries_ = OrderedDict()
+        self.size_ = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Bytes held in memory by the arrays of a measurement or a derived entry
+    @staticmethod
+    def memory_size(entry):
+        return sum(
+            c.nbytes
+            for c in vars(entry).values()
+            if isinstance(c, np.ndarray) and not isinstance(c, np.memmap) and not isinstance(c.base, np.memmap)
+        )
+
+    def __call__(self, path):
+        return self.entry(path, lambda: load_measurement(path))
+
+    # Returns the entry stored under key, building it if it isn't cached yet. Entries that are None aren't kept.
+    def entry(self, key, build):
+        with self.mutex_:
+            if key in self.entries_:
+                self.entries_.move_to_end(key)
+                self.hits += 1
+                return self.entries_[key][0]
+            self.misses += 1
+
+        # Entries are built outside the lock, so several of them can load at once.
+        value = build()
+        if value is None:
+            return None
+        size = self.memory_size(value)
+        with self.mutex_:
+            if size <= self.max_size and key not in self.entries_:
+                self.entries_[key] = (value, size)
+                self.size_ += size
+                while self.size_ > self.max_size:
+                    _, (_, evicted_size) = self.entries_.popitem(last=False)
+                    self.size_ -= evicted_size
+        return value
+
+    # Drops the entries whose key matches
+    def discard(self, matches):
+        with self.mutex_:
+            for key in [key for key in self.entries_ if matches(key)]:
+                _, size = self.entries_.pop(key)
+                self.size_ -= size
+
+    def clear(self):
+        with self.mutex_:
+            self.entries_.clear()
+            self.size_ = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.mutex_:
+            requests = self.hits + self.misses
+            hit_rate = self.hits / requests if requests > 0 else 0
+            return (
+                f"{len(self.entries_)} entries loaded ({self.size_ / (1 << 20):.1f} of "
+                f"{self.max_size / (1 << 20):.1f} MiB), {hit_rate:.0%} of {requests} loads hit"
+            )
+
+
+# Starts writing a measurement whose deviations are too large to be held in memory.
+# Returns the deviations column memory-mapped in the staging directory, to be filled before write_measurement is called
+# with staged=True.
+def open_deviations(destination, length):
+    staging = destination + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    path = os.path.join(staging, "deviations.npy")
+    return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(length,))
+
+
+# Stores a measurement as a directory holding one .npy file per column.
+# The columns are written next to the destination first so that readers never see a partially written measurement.
+# If the deviations were staged with open_deviations, they are left as they are.
+def write_measurement(destination, data: measurement_data, staged=False):
     try:
-        with open(destination, "wb") as out:
-            pickle.dump(obj, out, protocol=pickle.HIGHEST_PROTOCOL)
+        staging = destination + ".tmp"
+        if not staged:
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+        for c in measurement_data.columns + measurement_data.summary_columns:
+            if staged and c == "deviations":
+                continue
+            np.save(os.path.join(staging, f"{c}.npy"), getattr(data, c))
+        shutil.rmtree(destination, ignore_errors=True)
+        os.rename(staging, destination)
 
     except Exception as e:
         print(f"Failed to write measurement {destination}: {e}")
@@ -258,9 +671,21 @@ def iterate_measurements(root):
                         parts = measurement.name.split(".")
                         inf.noise_pattern = parts[0]
                         inf.params = parts[1]
-                        inf.dirs = [measurement]
+                        # Plain paths keep the info picklable for worker processes.
+                        inf.dirs = [measurement.path]
                         yield copy.copy(inf)
 
 
+# Parses a size such as "512M" or "4G" into bytes. Plain numbers are interpreted as bytes.
+def parse_size(size: str):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper()
+    if size.endswith("B"):
+        size = size[:-1]
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def warn(msg):
     print(colored(f"[WARNING] {msg}", "yellow"))
@@ -32,7 +32,7 @@ from norc.ui.ui_util import score_color
 import norc.helpers.util as util
 import norc.core.plot_rel_dev as prd
 import norc.core.score as scr
-from norc.core.plotmanager import PlotManager
+from norc.core.plotmanager import PlotManager, priority_chart
 
 
 class chart_controls(QWidget):
@@ -210,7 +210,8 @@ class chart(QSplitter):
         # This may just spawn an asynchronous calculation instead of plotting.
         # This function will be called again when the result is ready if that is the case.
         self.plt_mgr.get_plot(self.ax, self.controls.plot_info)
+        self.plt_mgr.prefetch_plots(self.controls.plot_info)
         self.fig.canvas.draw_idle()
 
     def update_score(self):
-        self.controls.set_score(self.plt_mgr.request_score(self.controls.plot_info))
+        self.controls.set_score(self.plt_mgr.request_score(self.controls.plot_info, priority_chart))
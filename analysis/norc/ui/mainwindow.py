@@ -11,7 +11,7 @@ from copy import copy
 from PySide6.QtWidgets import QFileDialog, QMessageBox, QMainWindow, QCheckBox
 from PySide6.QtCore import Qt
 
-from norc.helpers.util import experiment_filter, available_measurements
+from norc.helpers.util import experiment_filter
 from norc.ui.examine_tab import examine_tab
 from norc.ui.ratings_tab import ratings_tab
 from norc.core.analyze import analyze_experiment
@@ -51,8 +51,15 @@ class main_window(QMainWindow):
         self.update_filter_ui()
         self.appstate.plt_mgr.reconfigured.connect(self.update_filter_ui)
 
+        self.appstate.plt_mgr.result_ready.connect(self.update_status)
+        self.appstate.plt_mgr.score_ready.connect(self.update_status)
+
         self.ui.show()
 
+    # Shows how well loaded measurements are reused between calculations.
+    def update_status(self):
+        self.ui.statusbar.showMessage(self.appstate.plt_mgr.measurements.stats())
+
     def update_config(self):
         self.appstate.plt_mgr.set_plotmode(self.ui.cb_plotmode.currentText())
         self.appstate.plt_mgr.set_colorbands(self.ui.sb_colorbands.value())
@@ -137,8 +144,7 @@ class main_window(QMainWindow):
         self.filter_boxes = {"benchmark": [], "system": [], "noise": [], "counter": []}
 
         # Check if there is anything to load
-        deviation_dir = os.path.join(plt_mgr.experiment_root, "result", ".deviations")
-        if not os.path.exists(deviation_dir):
+        if plt_mgr.catalog is None:
             return
 
         # Get all available plot infos
@@ -147,7 +153,7 @@ class main_window(QMainWindow):
         noises = set()
         metrics = set()
 
-        for inf in available_measurements(deviation_dir, sel).values():
+        for inf in plt_mgr.catalog.measurements(sel).values():
             benchmarks.add(inf.benchmark)
             systems.add(inf.system)
             noises.add(inf.noise_pattern)
@@ -18,7 +18,7 @@ import numpy as np
 
 import norc.helpers.util as util
 from norc.ui.ui_util import score_color
-from norc.core.plotmanager import PlotManager
+from norc.core.plotmanager import PlotManager, priority_table, priority_prefetch
 from norc.ui.qt_utils import table_dimensions
 
 
@@ -42,7 +42,10 @@ class score_cell(QTableWidgetItem):
         self.setForeground(QColor(0, 0, 0))
 
     def update_score(self):
-        score = self.plt_mgr.request_score(self.info)
+        # Scores of tables that aren't shown, e.g. on another tab, are only calculated after the visible ones.
+        table = self.tableWidget()
+        priority = priority_prefetch if table is not None and not table.isVisible() else priority_table
+        score = self.plt_mgr.request_score(self.info, priority)
         if score is None or np.isinf(score.rel_resilience):
             self.setText("-")
             self.set_bg(QColor(255, 255, 255))
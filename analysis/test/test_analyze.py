@@ -0,0 +1,241 @@
+# This file is part of the NORC software
+#
+# Copyright (c) 2025, Technical University of Darmstadt, Germany
+#
+# This software may be modified and distributed under the terms of a BSD-style license.
+# See the LICENSE file in the base directory for details.
+
+import io
+import os
+import struct
+import tarfile
+import tracemalloc
+import zlib
+import numpy as np
+import pytest
+
+from norc.core.analyze import analyze_experiment, read_manifest
+from norc.helpers.util import load_measurement, parse_size
+
+n_threads = 2
+metrics = [("PAPI_TOT_INS", "UINT64"), ("time", "DOUBLE"), ("visits", "UINT64")]
+measurement_dirs = [
+    os.path.join("bench", "sys", f"1n1p{n_threads}t", "PAPI_TOT_INS", f"{noise}.p1") for noise in ["NO_NOISE", "cpu"]
+]
+
+
+# Returns the call tree of a run as nested (region, children) tuples.
+# Odd runs have an additional callee, which shifts the ids of all cnodes after it. The same path also appears twice.
+def call_tree(run):
+    solve = ("solve", [("MPI_Send", []), ("MPI_Recv", [])])
+    extra = [("init", [])] if run % 2 else []
+    return ("main", extra + [solve, ("io", [("MPI_Send", [])]), ("io", [("MPI_Send", [])])])
+
+
+def anchor(tree, regions, threads=n_threads):
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>', '<cube version="4.4">', "<metrics>"]
+    for i, (name, dtype) in enumerate(metrics):
+        xml.append(
+            f'<metric id="{i}" type="EXCLUSIVE"><disp_name>{name}</disp_name><uniq_name>{name}</uniq_name>'
+            f"<dtype>{dtype}</dtype><uom>occ</uom><url></url><descr></descr></metric>"
+        )
+    xml.append("</metrics><program>")
+    for i, name in enumerate(regions):
+        xml.append(
+            f'<region id="{i}" mod="" begin="0" end="0"><name>{name}</name><mangled_name>{name}</mangled_name>'
+            "<paradigm>user</paradigm><role>function</role><url></url><descr></descr></region>"
+        )
+
+    n_cnodes = 0
+
+    def add_cnode(cnode):
+        nonlocal n_cnodes
+        xml.append(f'<cnode id="{n_cnodes}" calleeId="{regions.index(cnode[0])}">')
+        n_cnodes += 1
+        for child in cnode[1]:
+            add_cnode(child)
+        xml.append("</cnode>")
+
+    add_cnode(tree)
+    xml.append('</program><system><systemtreenode Id="0" class="machine"><name>m</name>')
+    xml.append('<locationgroup Id="0"><name>p</name><rank>0</rank><type>process</type>')
+    for i in range(threads):
+        xml.append(f'<location Id="{i}"><name>t{i}</name><rank>{i}</rank><type>thread</type></location>')
+    xml.append("</locationgroup></systemtreenode></system></cube>")
+    return "\n".join(xml).encode(), n_cnodes
+
+
+def add_member(archive, name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    archive.addfile(member, io.BytesIO(data))
+
+
+# Compresses data in chunks of at most chunk_size bytes like cubelib, with an empty entry in between.
+def compress_data(data, chunk_size=1000):
+    chunks = [zlib.compress(data[i : i + chunk_size]) for i in range(0, len(data), chunk_size)]
+    entries = [(0, 0, len(chunk)) for chunk in chunks] + [(len(data), 0, 0)]
+    entries = [entries[-1]] + entries[:-1]
+    header = struct.pack(f"<q{3 * len(entries)}q", len(entries), *(x for entry in entries for x in entry))
+    return b"ZCUBEX.DATA" + header + b"".join(chunks)
+
+
+# Overwrites the checksums of all tar headers, as CubeWriter 4.8 writes wrong ones.
+def break_checksums(path):
+    with tarfile.open(path) as archive:
+        offsets = [member.offset for member in archive.getmembers()]
+    with open(path, "r+b") as f:
+        for offset in offsets:
+            f.seek(offset + 148)
+            f.write(b"0000000\0")
+
+
+# Writes a profile of a call tree. The values of each metric are drawn as a (cnodes x threads) array.
+def write_cubex(path, tree, threads, draw_values, compressed=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    xml, n_cnodes = anchor(tree, ["main", "init", "solve", "io", "MPI_Send", "MPI_Recv"], threads)
+    with tarfile.open(path, "w") as archive:
+        add_member(archive, "anchor.xml", xml)
+        for i, (name, dtype) in enumerate(metrics):
+            index = struct.pack(f"<ihbi{n_cnodes}i", 1, 1, 0, n_cnodes, *range(n_cnodes))
+            values = draw_values(dtype, (n_cnodes, threads)).astype("<f8" if dtype == "DOUBLE" else "<u8")
+            add_member(archive, f"{i}.index", b"CUBEX.INDEX" + index)
+            data = compress_data(values.tobytes()) if compressed else b"CUBEX.DATA" + values.tobytes()
+            add_member(archive, f"{i}.data", data)
+
+
+# Writes the profile of a run of a measurement. The same run always yields the same values.
+def write_profile(root, measurement, run, compressed=False):
+    path = os.path.join(root, "result", measurement_dirs[measurement], f"run{run}", "profile.cubex")
+    rng = np.random.default_rng([measurement, run])
+
+    def draw_values(dtype, shape):
+        if dtype == "DOUBLE":
+            return rng.gamma(2.0, 1.0, size=shape)
+        return rng.integers(1, 1000, size=shape)
+
+    write_cubex(path, call_tree(run), n_threads, draw_values, compressed)
+    return path
+
+
+def write_runs(root, runs, compressed=False):
+    for measurement in range(len(measurement_dirs)):
+        for run in runs:
+            write_profile(root, measurement, run, compressed)
+
+
+def load_results(root):
+    output_dir = os.path.join(root, "result", ".deviations")
+    return {
+        name: load_measurement(os.path.join(output_dir, name)).to_callpaths()
+        for name in os.listdir(output_dir)
+        if name.endswith(".dev")
+    }
+
+
+# Results are equal up to the order of the runs of each callpath, which follows the order the profiles were read in.
+def assert_same_results(expected, actual):
+    assert expected.keys() == actual.keys()
+    for name, callpaths in expected.items():
+        assert [cp.name for cp in callpaths] == [cp.name for cp in actual[name]], name
+        for a, b in zip(callpaths, actual[name]):
+            assert np.isclose(a.visits, b.visits)
+            assert np.isclose(a.contribution, b.contribution)
+            assert np.allclose(np.sort(a.deviations), np.sort(b.deviations))
+
+
+@pytest.mark.parametrize("initial_runs", [[0, 2], [1, 3], [0, 1]])
+def test_incremental_matches_rebuild(tmp_path, initial_runs):
+    full = tmp_path / "full"
+    write_runs(full, range(5))
+    analyze_experiment(full, rebuild=True)
+
+    incremental = tmp_path / "incremental"
+    write_runs(incremental, initial_runs)
+    analyze_experiment(incremental)
+    write_runs(incremental, [run for run in range(5) if run not in initial_runs])
+    analyze_experiment(incremental)
+
+    results = load_results(full)
+    assert set(results) == {
+        f"bench.p1.{noise}.sys.1n1p{n_threads}t.{metric}.dev"
+        for noise in ["NO_NOISE", "cpu", "ALL_NOISE"]
+        for metric in ["PAPI_TOT_INS", "time"]
+    }
+    # Both paths to MPI_Send through io are kept, as well as the callee that only some runs have.
+    assert sorted(cp.name for cp in results[f"bench.p1.NO_NOISE.sys.1n1p{n_threads}t.time.dev"]) == sorted(
+        ["main", "init", "solve", "io", "io", "MPI_Send", "MPI_Send", "MPI_Send", "MPI_Recv"]
+    )
+    assert_same_results(results, load_results(incremental))
+
+
+def test_unreadable_profiles_are_read_again(tmp_path):
+    root = tmp_path / "experiment"
+    write_runs(root, range(2))
+    broken = os.path.join(root, "result", measurement_dirs[0], "run2", "profile.cubex")
+    os.makedirs(os.path.dirname(broken))
+    with open(broken, "wb") as f:
+        f.write(b"not a profile")
+
+    analyze_experiment(root)
+    state_root = os.path.join(root, "result", ".deviations", ".state")
+    recorded = [
+        path
+        for task in os.listdir(state_root)
+        for profiles in read_manifest(os.path.join(state_root, task))["profiles"].values()
+        for path in profiles
+    ]
+    assert len(recorded) == 4
+    assert not any(path.startswith(os.path.join(measurement_dirs[0], "run2")) for path in recorded)
+
+    write_profile(root, 0, 2)
+    analyze_experiment(root)
+
+    full = tmp_path / "full"
+    write_runs(full, range(2))
+    write_profile(full, 0, 2)
+    analyze_experiment(full, rebuild=True)
+    assert_same_results(load_results(full), load_results(root))
+
+
+def test_profile_formats(tmp_path):
+    plain = tmp_path / "plain"
+    write_runs(plain, range(3))
+    analyze_experiment(plain)
+
+    # Compressed data and wrong header checksums yield the same values as plain profiles.
+    written = tmp_path / "written"
+    write_runs(written, range(3), compressed=True)
+    break_checksums(write_profile(written, 1, 1))
+    analyze_experiment(written)
+    assert_same_results(load_results(plain), load_results(written))
+
+
+# Writes runs of a measurement with many threads and analyzes them, returning the peak of the traced memory.
+# Like in real measurements, values vary by about 1% between runs.
+def traced_analysis(root, runs, memory_budget):
+    threads = 256
+    tree = ("main", [("solve", [("MPI_Send", []), ("MPI_Recv", [])])] * 20)
+    measurement_dir = os.path.join(root, "result", "bench", "sys", f"1n1p{threads}t", "PAPI_TOT_INS", "NO_NOISE.p1")
+    for run in range(runs):
+        rng = np.random.default_rng(run)
+        draw_values = lambda dtype, shape: rng.normal(1e6, 1e4, size=shape)
+        write_cubex(os.path.join(measurement_dir, f"run{run}", "profile.cubex"), tree, threads, draw_values)
+
+    tracemalloc.start()
+    try:
+        analyze_experiment(root, memory_budget=memory_budget)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# The values of 40 runs take about 14 MiB, seven times the budget. Apart from the budget, reading a profile and the
+# callpath ids of all values need memory, which is bounded by the peak of analyzing a single run.
+def test_memory_budget_bounds_peak_memory(tmp_path):
+    single = traced_analysis(tmp_path / "single", 1, 0)
+    budget = parse_size("2M")
+    assert traced_analysis(tmp_path / "budget", 40, budget) < budget + single
+
+    traced_analysis(tmp_path / "unlimited", 40, 0)
+    assert_same_results(load_results(tmp_path / "unlimited"), load_results(tmp_path / "budget"))
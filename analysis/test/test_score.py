@@ -0,0 +1,214 @@
+# This file is part of the NORC software
+#
+# Copyright (c) 2025, Technical University of Darmstadt, Germany
+#
+# This software may be modified and distributed under the terms of a BSD-style license.
+# See the LICENSE file in the base directory for details.
+
+import os
+import numpy as np
+import pytest
+
+from norc.core.score import (
+    deviation_score_from_data,
+    get_filtered_data,
+    threshold_index,
+    score,
+    score_group,
+    sensitivity_score,
+)
+from norc.helpers.util import (
+    callpath_data,
+    data_selection,
+    measurement_data,
+    measurement_info,
+    deviation_bins,
+    write_measurement,
+)
+
+
+def make_callpaths(seed, n_callpaths, zero_contributions=False):
+    rng = np.random.default_rng(seed)
+    callpaths = []
+    for i in range(n_callpaths):
+        cp = callpath_data(f"region{i % 4}")
+        # Deviations include values on bin edges and beyond the last bin.
+        cp.deviations = np.concatenate([rng.gamma(1.0, 20.0, size=rng.integers(1, 50)), [0.25 * i, 100.0, 2000.0]])
+        cp.visits = float(rng.integers(0, 100))
+        cp.contribution = 0.0 if zero_contributions else float(rng.choice([0.0, rng.uniform(0, 30)]))
+        callpaths.append(cp)
+    return callpaths
+
+
+# Stores each list of callpaths as a measurement and returns the info describing all of them.
+def write_info(root, measurements):
+    info = measurement_info()
+    info.file_paths = []
+    for name, callpaths in measurements.items():
+        path = os.path.join(root, f"{name}.dev")
+        write_measurement(path, measurement_data.from_callpaths(callpaths))
+        info.file_paths.append(path)
+    return info
+
+
+def selection(visit_threshold, contrib_threshold):
+    s = data_selection()
+    s.visit_threshold = visit_threshold
+    s.contrib_threshold = contrib_threshold
+    return s
+
+
+# Reference implementations with a loop over the callpaths, as the kernels were written before they were vectorized.
+# Deviations are read back with the precision they are stored with.
+def stored_deviations(cp):
+    return np.asarray(cp.deviations, dtype=np.float32).astype(np.float64)
+
+
+def selected_callpaths(callpaths, selection):
+    return [
+        cp
+        for cp in callpaths
+        if cp.visits >= selection.visit_threshold and cp.contribution >= selection.contrib_threshold
+    ]
+
+
+def reference_mean(callpaths):
+    score = 0.0
+    total_contribution = 0.0
+    for cp in callpaths:
+        devs = stored_deviations(cp)
+        score += cp.contribution * np.sum(devs) / len(devs)
+        total_contribution += cp.contribution
+    return 0.0 if total_contribution == 0 else score / total_contribution
+
+
+def reference_moments(callpaths):
+    total_contribution = sum(cp.contribution for cp in callpaths)
+    if total_contribution == 0:
+        return 0.0, 0.0
+    mu = sum(np.sum(stored_deviations(cp)) / len(cp.deviations) * cp.contribution for cp in callpaths)
+    mu /= total_contribution
+    sigma_sq = 0.0
+    for cp in callpaths:
+        devs = stored_deviations(cp)
+        sigma_sq += (np.sum(devs * devs) - 2 * mu * np.sum(devs) + len(devs) * mu**2) / len(devs) * cp.contribution
+    return mu, sigma_sq / total_contribution
+
+
+def reference_resilience(scores, s):
+    finite = [x for x in scores if not np.isinf(x.deviation())]
+    if np.isinf(s.deviation()) or np.isinf(s.susceptibility):
+        return -np.inf
+    min_d = min(x.deviation() for x in finite) / max(x.deviation() for x in finite)
+    min_s = min(x.susceptibility for x in finite) / max(x.susceptibility for x in finite)
+    weight = min(1.0, min_s / min_d)
+    d = s.deviation() / max(x.deviation() for x in finite)
+    sus = s.susceptibility / max(x.susceptibility for x in finite)
+    return 1.0 / ((1.0 + d) * (1.0 + sus * weight))
+
+
+def test_summaries_match_reference():
+    callpaths = make_callpaths(0, 20)
+    empty = callpath_data("empty")
+    callpaths.insert(3, empty)
+    data = measurement_data.from_callpaths(callpaths)
+
+    for i, cp in enumerate(callpaths):
+        devs = stored_deviations(cp)
+        assert data.counts[i] == len(devs)
+        assert np.isclose(data.sums[i], np.sum(devs))
+        assert np.isclose(data.sumsqs[i], np.sum(devs * devs))
+        assert data.maxima[i] == np.max(devs, initial=0)
+        expected, _ = np.histogram(devs, bins=deviation_bins())
+        assert np.array_equal(data.histogram(i), expected)
+
+
+@pytest.mark.parametrize(
+    "thresholds",
+    [(0, 0), (20, 0), (0, 5), (20, 5), (0, 1e9), (1e9, 0), (1e9, 1e9)],
+)
+def test_scores_match_reference(tmp_path, thresholds):
+    noisy = {"a": make_callpaths(1, 30), "b": make_callpaths(2, 10)}
+    ref = {"c": make_callpaths(3, 20)}
+    noisy_info = write_info(tmp_path, noisy)
+    ref_info = write_info(tmp_path, ref)
+    sel = selection(*thresholds)
+    expected_noisy = selected_callpaths(noisy["a"] + noisy["b"], sel)
+    expected_ref = selected_callpaths(ref["c"], sel)
+
+    # Calculations must not divide by zero, even if the thresholds exclude every callpath.
+    with np.errstate(all="raise"):
+        noisy_data = get_filtered_data(noisy_info, sel)
+        ref_data = get_filtered_data(ref_info, sel)
+        totals = threshold_index(get_filtered_data(noisy_info, None)).totals(sel)
+
+        assert len(noisy_data) == len(totals) == len(expected_noisy)
+        assert np.allclose(deviation_score_from_data(noisy_data, sel), reference_mean(expected_noisy))
+        assert np.allclose(noisy_data.mean(), reference_mean(expected_noisy))
+        assert np.allclose(totals.mean(), reference_mean(expected_noisy))
+        assert np.allclose(noisy_data.moments(), reference_moments(expected_noisy))
+        assert np.allclose(totals.moments(), reference_moments(expected_noisy))
+
+        if not expected_noisy or not expected_ref:
+            return
+        mu_noisy, sigma_sq_noisy = reference_moments(expected_noisy)
+        mu_ref, sigma_sq_ref = reference_moments(expected_ref)
+        assert np.allclose(
+            sensitivity_score(noisy_info, ref_info, sel, noisy_data, ref_data),
+            abs(mu_noisy - mu_ref) / np.sqrt(sigma_sq_noisy + sigma_sq_ref),
+        )
+
+
+def test_zero_contributions(tmp_path):
+    info = write_info(tmp_path, {"a": make_callpaths(3, 10, zero_contributions=True)})
+    sel = selection(0, 0)
+
+    with np.errstate(all="raise"):
+        data = get_filtered_data(info, sel)
+        totals = threshold_index(get_filtered_data(info, None)).totals(sel)
+        assert len(data) == len(totals) == 10
+        assert deviation_score_from_data(data, sel) == data.mean() == totals.mean() == 0.0
+        assert data.moments() == totals.moments() == (0.0, 0.0)
+        assert sensitivity_score(info, info, sel, data, totals) == 0.0
+
+
+# Expanding the variance of constant deviations cancels, which must not leave a negative variance behind.
+# Both cases round below 0 without clamping, the first one in filtered_data and the second one in the totals.
+@pytest.mark.parametrize("deviation, count, contribution", [(99.61, 11, 12.2), (0.1, 3, 47.7)])
+def test_constant_deviations(tmp_path, deviation, count, contribution):
+    cp = callpath_data("constant")
+    cp.deviations = [deviation] * count
+    cp.visits = 1.0
+    cp.contribution = contribution
+    info = write_info(tmp_path, {"a": [cp, cp]})
+    sel = selection(0, 0)
+
+    with np.errstate(all="raise"):
+        data = get_filtered_data(info, sel)
+        totals = threshold_index(get_filtered_data(info, None)).totals(sel)
+        assert data.moments()[1] >= 0.0
+        assert totals.moments()[1] >= 0.0
+        assert sensitivity_score(info, info, sel, data, totals) == 0.0
+
+
+def test_score_group_matches_reference(tmp_path):
+    ref_info = write_info(tmp_path, {"ref": make_callpaths(4, 20)})
+    sel = selection(0, 0)
+    seeds = iter(range(5, 100))
+
+    def random_score():
+        seed = next(seeds)
+        return score(write_info(tmp_path, {f"noisy{seed}": make_callpaths(seed, 10)}), ref_info, sel)
+
+    scores = {i: random_score() for i in range(8)}
+    # A measurement without data has infinite scores and is left out of the extrema.
+    scores[8] = score(measurement_info(), ref_info, sel)
+    group = score_group(scores)
+    # Replacing scores may both widen and narrow the extrema.
+    for key in [2, 5, 2]:
+        scores[key] = random_score()
+        group.put(key, scores[key])
+
+    assert np.isinf(scores[8].deviation())
+    for s in scores.values():
+        assert np.isclose(s.rel_resilience, reference_resilience(scores.values(), s))